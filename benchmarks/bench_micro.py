@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+"""
+Micro-benchmarks of the hot functions of the parsers, with a stored
+baseline to compare against:
+
+    python bench_micro.py list
+    python bench_micro.py record  [--baseline FILE] [--filter TEXT] [--samples 20]
+    python bench_micro.py compare [--baseline FILE] [--filter TEXT] [--threshold 0.1]
+                                  [--alpha 0.01]
+
+record times every benchmark (or those whose name contains TEXT) and saves
+the samples to the baseline file, by default baseline.json next to this
+script. compare times them again and exits with status 1 if any benchmark
+regressed: its median time per call grew by more than threshold (a
+fraction) and a Mann-Whitney U test of the two sets of samples says the
+difference isn't noise (p < alpha).
+
+Baselines are only comparable on the same machine, Python and numpy; the
+ones recorded with are shown when they differ.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import timeit
+
+import corpus
+from corpus import genesis, nintendo64, snes
+
+from pyrominfo.rominfo import RomInfoParser, RomView
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# (name, setup) of the benchmarks. setup() returns the function to time.
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+@benchmark("RomInfoParser._sanitize")
+def benchSanitize():
+    parser = RomInfoParser()
+    title = bytearray(b"SUPER MARIOWORLD\x00\xff\x81  ")
+    return lambda: parser._sanitize(title)
+
+@benchmark("RomInfoParser._allASCII")
+def benchAllASCII():
+    parser = RomInfoParser()
+    title = bytearray(b"SUPER MARIOWORLD      ")
+    return lambda: parser._allASCII(title)
+
+@benchmark("SNESParser.scoreHiRom")
+def benchScoreHiRom():
+    parser = snes.SNESParser()
+    data = corpus.makeSNES(0x400000, "HiROM")["benchmark.smc"]
+    return lambda: parser.scoreHiRom(data)
+
+@benchmark("SNESParser.scoreLoRom")
+def benchScoreLoRom():
+    parser = snes.SNESParser()
+    data = corpus.makeSNES(0x400000)["benchmark.smc"]
+    return lambda: parser.scoreLoRom(data)
+
+@benchmark("SNESParser.scoreHiRom[RomView]")
+def benchScoreHiRomView():
+    parser = snes.SNESParser()
+    data = RomView(bytes(corpus.makeSNES(0x400000, "HiROM")["benchmark.smc"]))
+    return lambda: parser.scoreHiRom(data)
+
+@benchmark("SNESParser.deinterleaveType1")
+def benchDeinterleaveType1():
+    parser = snes.SNESParser()
+    data = corpus.makePayload(0x100000)
+    return lambda: parser.deinterleaveType1(data, len(data))
+
+@benchmark("GensisParser.deinterleaveSMD")
+def benchDeinterleaveSMD():
+    parser = genesis.GensisParser()
+    data = corpus.makePayload(0x100000)
+    return lambda: parser.deinterleaveSMD(data)
+
+@benchmark("GensisParser.isInterleaved")
+def benchIsInterleaved():
+    parser = genesis.GensisParser()
+    data = corpus.makeGenesis(0x80000)["benchmark.bin"]
+    return lambda: parser.isInterleaved(data)
+
+@benchmark("Nintendo64Parser.makeNativeFormat[v64]")
+def benchMakeNativeFormatV64():
+    parser = nintendo64.Nintendo64Parser()
+    data = corpus.makePayload(0x100000)
+    return lambda: parser.makeNativeFormat(data, nintendo64.Nintendo64Parser.MAGIC_V64)
+
+@benchmark("Nintendo64Parser.makeNativeFormat[n64]")
+def benchMakeNativeFormatN64():
+    parser = nintendo64.Nintendo64Parser()
+    data = corpus.makePayload(0x100000)
+    return lambda: parser.makeNativeFormat(data, nintendo64.Nintendo64Parser.MAGIC_N64)
+
+def registerProbes():
+    """
+    Benchmark isValidData() of every parser, as RomInfo.parse() calls it on
+    files of unknown extensions: on a RomView of an image the parser accepts
+    (hit) and of one it doesn't (miss).
+    """
+    images = [
+        ("GameboyParser", corpus.makeGameboy, 0x8000),
+        ("GBAParser", corpus.makeGBA, 0x100000),
+        ("GensisParser", corpus.makeGenesis, 0x80000),
+        ("MasterSystemParser", corpus.makeSMS, 0x20000),
+        ("NESParser", corpus.makeNES, 0x40000),
+        ("Nintendo64Parser", corpus.makeN64, 0x400000),
+        ("SNESParser", lambda size: corpus.makeSNES(size, copierHeader=True), 0x80000),
+    ]
+    parsers = dict((type(parser).__name__, parser) for parser in RomInfoParser.getParsers())
+    for (name, builder, size) in images:
+        def setup(name=name, builder=builder, size=size, hit=True):
+            image = list(builder(size).values())[0] if hit else corpus.makePayload(size, seed=2)
+            data = RomView(bytes(image))
+            parser = parsers[name]
+            return lambda: parser.isValidData(data)
+        benchmark("%s.isValidData[hit]" % name)(setup)
+        benchmark("%s.isValidData[miss]" % name)(lambda setup=setup: setup(hit=False))
+
+registerProbes()
+
+def measure(func, samples, minTime):
+    """
+    Return samples timings of func in seconds per call. Each sample calls
+    func enough times in a row to take at least minTime seconds.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < minTime:
+        number *= 2
+    return [timer.timeit(number) / number for i in range(samples)]
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+def mannWhitneyU(a, b):
+    """
+    Two-sided p-value of the Mann-Whitney U test of samples a and b, with the
+    normal approximation (corrected for ties), which is fine from about 10
+    samples each.
+    """
+    values = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    n = len(values)
+    ranks = [0.0] * n
+    ties = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        i = j + 1
+    (n1, n2) = (len(a), len(b))
+    u = sum(rank for (rank, (x, group)) in zip(ranks, values) if group == 0) - n1 * (n1 + 1) / 2.0
+    sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+    if not sigma:
+        return 1.0
+    z = (u - n1 * n2 / 2.0) / sigma
+    return math.erfc(abs(z) / math.sqrt(2))
+
+def getEnvironment():
+    try:
+        import numpy
+        numpyVersion = numpy.__version__
+    except ImportError:
+        numpyVersion = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.system(),
+        "numpy": numpyVersion,
+    }
+
+def runBenchmarks(pattern, samples, minTime):
+    """
+    Yield (name, samples) of the benchmarks whose name contains pattern.
+    """
+    for (name, setup) in BENCHMARKS:
+        if pattern in name:
+            yield (name, measure(setup(), samples, minTime))
+
+def formatTime(seconds):
+    for (unit, scale) in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.1f ns" % (seconds / 1e-9)
+
+def record(args):
+    baseline = {"environment": getEnvironment(), "benchmarks": {}}
+    if args.filter and os.path.exists(args.baseline):
+        # Only the filtered benchmarks are replaced
+        with open(args.baseline) as f:
+            baseline["benchmarks"] = json.load(f)["benchmarks"]
+    for (name, times) in runBenchmarks(args.filter, args.samples, args.min_time):
+        baseline["benchmarks"][name] = {"median": median(times), "samples": times}
+        print("%-45s %12s" % (name, formatTime(median(times))))
+        sys.stdout.flush()
+    with open(args.baseline, "w") as f:
+        json.dump(baseline, f, indent=2, separators=(",", ": "), sort_keys=True)
+    return 0
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    environment = getEnvironment()
+    for (key, value) in sorted(baseline.get("environment", {}).items()):
+        if environment.get(key) != value:
+            print("Warning: baseline recorded with %s %s, running %s" % (key, value, environment.get(key)))
+
+    regressions = []
+    row = "%-45s %12s %12s %8s %8s  %s"
+    print(row % ("benchmark", "baseline", "current", "change", "p", "status"))
+    for (name, times) in runBenchmarks(args.filter, args.samples, args.min_time):
+        current = median(times)
+        if name not in baseline["benchmarks"]:
+            print(row % (name, "-", formatTime(current), "-", "-", "new"))
+            continue
+        before = baseline["benchmarks"][name]
+        change = current / before["median"] - 1
+        p = mannWhitneyU(before["samples"], times)
+        status = "ok"
+        if p < args.alpha and change > args.threshold:
+            status = "REGRESSED"
+            regressions.append(name)
+        elif p < args.alpha and change < -args.threshold:
+            status = "improved"
+        print(row % (name, formatTime(before["median"]), formatTime(current), "%+.1f%%" % (change * 100),
+                     "%.3f" % p, status))
+        sys.stdout.flush()
+
+    if regressions:
+        print("%d benchmark(s) regressed by more than %d%%: %s" %
+              (len(regressions), args.threshold * 100, ", ".join(regressions)))
+        return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the parsers' hot functions")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("list", help="list the benchmarks")
+    for (command, help) in [("record", "time the benchmarks and save them as the baseline"),
+                            ("compare", "time the benchmarks and compare them to the baseline")]:
+        sub = commands.add_parser(command, help=help)
+        sub.add_argument("--baseline", default=BASELINE, help="baseline file (default: %(default)s)")
+        sub.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+        sub.add_argument("--samples", type=int, default=20, help="timings per benchmark (default: %(default)s)")
+        sub.add_argument("--min-time", type=float, default=0.01,
+                         help="minimum seconds per timing (default: %(default)s)")
+        if command == "compare":
+            sub.add_argument("--threshold", type=float, default=0.1,
+                             help="slowdown of the median that is a regression (default: %(default)s)")
+            sub.add_argument("--alpha", type=float, default=0.01,
+                             help="significance level of the slowdown (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for (name, setup) in BENCHMARKS:
+            print(name)
+        return 0
+    if args.command == "record":
+        return record(args)
+    return compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+"""
+End-to-end benchmark of RomInfo.parse() over the synthetic corpus (see
+corpus.py). Every platform, variant and size class is parsed repeatedly in a
+fresh interpreter, which reports files/s, MB/s (of image size) and its peak
+resident set size. The first parse of each image warms the OS page cache
+and checks the result, and isn't timed.
+
+    python bench_parse.py [--sizes small,medium,large] [--platforms snes,n64]
+                          [--repeat 10] [--hashes crc32,sha1] [--corpus DIR]
+                          [--json results.json]
+
+The corpus is generated in a temporary directory, unless --corpus names one
+to keep (and reuse) it in.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import corpus
+
+from pyrominfo import RomInfo
+
+def getPeakRSS():
+    """
+    Peak resident set size of this process in bytes, None if unknown.
+    """
+    # Linux carries ru_maxrss over from the parent across fork() and exec(),
+    # but the high water mark of the address space starts afresh
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on OS X, kilobytes elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def runCase(path, repeat, hashes):
+    """
+    Parse path repeat times, returning the elapsed time and the peak RSS.
+    """
+    props = RomInfo.parse(path, hashes=hashes)
+    # iNES images have no title
+    title = props.get("title", props.get("game_title"))
+    if not props or title not in (corpus.TITLE, ""):
+        raise ValueError("%s parsed as %r" % (path, props))
+    start = timeit.default_timer()
+    for i in range(repeat):
+        RomInfo.parse(path, hashes=hashes)
+    elapsed = timeit.default_timer() - start
+    return {"elapsed": elapsed, "peak_rss": getPeakRSS()}
+
+def benchCase(path, repeat, hashes):
+    """
+    Run runCase() in a new interpreter, so that peak RSS is the case's own.
+    """
+    args = [sys.executable, os.path.abspath(__file__), "--case", path, "--repeat", str(repeat)]
+    if hashes:
+        args += ["--hashes", ",".join(hashes)]
+    return json.loads(subprocess.check_output(args).decode())
+
+def formatSize(size):
+    if size is None:
+        return "-"
+    return "%.2f" % (size / float(1 << 20))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RomInfo.parse() on a synthetic ROM corpus")
+    parser.add_argument("--sizes", default=",".join(corpus.SIZE_CLASSES),
+                        help="size classes to run (default: %(default)s)")
+    parser.add_argument("--platforms", default="",
+                        help="platforms to run (default: all of %s)" %
+                             ",".join(sorted(set(case[0] for case in corpus.CORPUS))))
+    parser.add_argument("--repeat", type=int, default=10, help="parses per image (default: %(default)s)")
+    parser.add_argument("--hashes", default="", help="digests to add, e.g. crc32,sha1")
+    parser.add_argument("--corpus", help="directory to write the corpus to and keep it in")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    hashes = [h for h in args.hashes.split(",") if h]
+
+    if args.case:
+        sys.stdout.write(json.dumps(runCase(args.case, args.repeat, hashes)))
+        return
+
+    directory = args.corpus or tempfile.mkdtemp(prefix="pyrominfo-corpus-")
+    try:
+        sizes = [s for s in args.sizes.split(",") if s]
+        platforms = [p for p in args.platforms.split(",") if p]
+        cases = corpus.writeCorpus(directory, sizes, platforms)
+
+        results = []
+        row = "%-10s %-12s %-7s %9s %10s %10s %10s"
+        print(row % ("platform", "variant", "class", "size MB", "files/s", "MB/s", "peak RSS"))
+        for (platform, variant, sizeClass, path, size) in cases:
+            result = benchCase(path, args.repeat, hashes)
+            filesPerSec = args.repeat / result["elapsed"]
+            result.update({
+                "platform": platform,
+                "variant": variant,
+                "size_class": sizeClass,
+                "size": size,
+                "repeat": args.repeat,
+                "files_per_sec": filesPerSec,
+                "mb_per_sec": filesPerSec * size / float(1 << 20),
+            })
+            results.append(result)
+            print(row % (platform, variant, sizeClass, formatSize(size), "%.1f" % result["files_per_sec"],
+                         "%.1f" % result["mb_per_sec"], formatSize(result["peak_rss"])))
+            sys.stdout.flush()
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"python": sys.version, "platform": sys.platform, "hashes": hashes,
+                           "results": results}, f, indent=2, separators=(",", ": "), sort_keys=True)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
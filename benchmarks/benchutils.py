@@ -0,0 +1,9 @@
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import os
+import sys
+
+# The image builders shared with the tests live in tests/testutils.py
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import testutils
@@ -0,0 +1,271 @@
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+"""
+Synthetic ROM corpus for the benchmarks. Every builder returns a dict of
+{filename: image} (Dreamcast GDI images are made of several files), with a
+valid header for its parser over a pseudo-random payload of the requested
+size. Images are deterministic, so runs on different machines parse the
+same bytes.
+"""
+
+import hashlib
+import os
+import struct
+
+from benchutils import testutils
+
+gameboy = testutils.loadModule("gameboy")
+gba = testutils.loadModule("gba")
+genesis = testutils.loadModule("genesis")
+mastersystem = testutils.loadModule("mastersystem")
+nes = testutils.loadModule("nes")
+nintendo64 = testutils.loadModule("nintendo64")
+snes = testutils.loadModule("snes")
+dreamcast = testutils.loadModule("dreamcast")
+
+TITLE = "BENCHMARK"
+
+SIZE_CLASSES = ["small", "medium", "large"]
+
+def makePayload(size, seed=0):
+    """
+    Return size pseudo-random bytes: a 64 KB block of chained SHA-1 digests,
+    repeated.
+    """
+    digest = hashlib.sha1(str(seed).encode()).digest()
+    block = bytearray()
+    while len(block) < 0x10000:
+        digest = hashlib.sha1(digest).digest()
+        block += digest
+    block = block[ : 0x10000]
+    return (block * (size // len(block) + 1))[ : size]
+
+def makeSNES(size, layout="LoROM", copierHeader=False, interleaved=False):
+    """
+    SNES image with its header at the place layout ("LoROM", "HiROM" or
+    "ExHiROM") puts it, and a valid checksum. HiROM images can be type 1
+    interleaved, and any image can get a 512-byte copier header.
+    """
+    parser = snes.SNESParser()
+    data = makePayload(size)
+    (offset, mapMode) = {
+        "LoROM": (0x7fb0, 0x20),
+        "HiROM": (0xffb0, 0x21),
+        "ExHiROM": (0x40ffb0, 0x25),
+    }[layout]
+    p = 0
+    while (1 << p) < size:
+        p += 1
+    header = bytearray(0x50)
+    header[0x00 : 0x06] = b"01BNCE"
+    header[0x10 : 0x25] = TITLE.encode().ljust(21)
+    header[0x25 : 0x2c] = bytearray([mapMode | 0x10, 0x02, p - 10, 0x03, 0x01, 0x33, 0x00])
+    header[0x2c : 0x30] = struct.pack("<HH", 0xffff, 0x0000)
+    # Reset vector
+    header[0x4c : 0x4e] = struct.pack("<H", 0x8000)
+    data[offset : offset + 0x50] = header
+    checksum = parser.calculateChecksum(data, False, offset, False)
+    data[offset + 0x2c : offset + 0x30] = struct.pack("<HH", checksum ^ 0xffff, checksum)
+
+    if interleaved:
+        # Inverse of SNESParser.deinterleaveType1()
+        order = parser.getType1BlockOrder(size)
+        plain = data[ : len(order) * 0x8000]
+        for (i, block) in enumerate(order):
+            data[block * 0x8000 : (block + 1) * 0x8000] = plain[i * 0x8000 : (i + 1) * 0x8000]
+    if copierHeader:
+        smc = bytearray(512)
+        smc[0 : 2] = struct.pack("<H", size >> 13)
+        smc[8 : 11] = b"\xaa\xbb\x04"
+        data = smc + data
+    return {"benchmark.smc": data}
+
+def makeGenesis(size, fmt="bin"):
+    """
+    Mega Drive image with a valid checksum, as a plain image ("bin"), in SMD
+    format (copier header and 16 KB interleaved blocks) or MD interleaved.
+    """
+    rom = makePayload(size)
+    rom[0x100 : 0x200] = b"".join([
+        b"SEGA MEGA DRIVE ",
+        b"(C)SEGA 2013.JAN",
+        TITLE.encode().ljust(48),
+        TITLE.encode().ljust(48),
+        b"GM 00001009-00",
+        b"\x00\x00",
+        b"J".ljust(16),
+        struct.pack(">IIII", 0, size - 1, 0xff0000, 0xffffff),
+        b" " * 12,
+        b" " * 12,
+        b" " * 40,
+        b"JUE".ljust(16),
+    ])
+    checksum = genesis.GensisParser().calculateChecksum(genesis.RomView(rom))
+    rom[0x18e : 0x190] = struct.pack(">H", checksum)
+    if fmt == "smd":
+        smd = bytearray(0x200)
+        smd[0 : 2] = bytearray([(size >> 14) & 0xff, 0x03])
+        smd[8 : 11] = b"\xaa\xbb\x06"
+        for i in range(0, size, 0x4000):
+            smd += rom[i + 1 : i + 0x4000 : 2] + rom[i : i + 0x4000 : 2]
+        return {"benchmark.smd": smd}
+    if fmt == "md":
+        return {"benchmark.md": rom[1 : : 2] + rom[0 : : 2]}
+    return {"benchmark.bin": rom}
+
+def makeN64(size, fmt="z64"):
+    """
+    Nintendo 64 image in native (z64), byteswapped (v64) or little endian
+    (n64) byte order.
+    """
+    data = makePayload(size)
+    data[0x00 : 0x40] = b"".join([
+        nintendo64.Nintendo64Parser.MAGIC_Z64,
+        b"\x00\x00\x00\x0f\x80\x00\x04\x00\x00\x00\x14\x49",
+        b"\x91\x6b\x8b\x5b\x78\x0b\x85\xa4",
+        b"\x00" * 8,
+        TITLE.encode().ljust(20),
+        b"\x00" * 7,
+        b"NBNE\x00",
+    ])
+    magic = {
+        "z64": None,
+        "v64": nintendo64.Nintendo64Parser.MAGIC_V64,
+        "n64": nintendo64.Nintendo64Parser.MAGIC_N64,
+    }[fmt]
+    if magic is not None:
+        # Byte swaps are their own inverse
+        nintendo64.Nintendo64Parser().makeNativeFormat(data, magic)
+    return {"benchmark." + fmt: data}
+
+def makeNES(size, fmt="ines"):
+    """
+    NES image of size bytes of PRG ROM and CHR ROM (7/8 and 1/8), with an
+    iNES 2.0 header or as UNIF chunks.
+    """
+    prgRom = makePayload(size // 8 * 7)
+    chrRom = makePayload(size // 8, seed=1)
+    if fmt == "unif":
+        def chunk(ID, data):
+            return ID + struct.pack("<I", len(data)) + bytes(data)
+        data = b"".join([
+            b"UNIF", struct.pack("<I", 7), b"\x00" * 24,
+            chunk(b"MAPR", b"NES-NROM-256\x00"),
+            chunk(b"PRG0", prgRom),
+            chunk(b"CHR0", chrRom),
+            chunk(b"NAME", TITLE.encode() + b"\x00"),
+            chunk(b"TVCI", b"\x01"),
+            chunk(b"BATR", b"\x01"),
+        ])
+        return {"benchmark.unf": bytearray(data)}
+    header = bytearray(b"NES\x1a") + bytearray([len(prgRom) >> 14, len(chrRom) >> 13, 0x02, 0x08])
+    return {"benchmark.nes": header.ljust(16, b"\x00") + prgRom + chrRom}
+
+def makeSMS(size):
+    """
+    Master System image with a SEGA header and an SDSC header and strings.
+    """
+    data = makePayload(size)
+    data[0x7fe0 : 0x8000] = b"SDSC\x01\x02\x31\x12\x01\x20\x01\x00\x01\x10\x30\x00" + \
+                            b"TMR SEGA\xff\xff\x12\x34\x26\x70\x00\x4c"
+    data[0x0100 : 0x0107] = b"Author\x00"
+    data[0x0110 : 0x0110 + len(TITLE) + 1] = TITLE.encode() + b"\x00"
+    data[0x3000 : 0x3012] = b"Synthetic image.\x00\x00"
+    return {"benchmark.sms": data}
+
+def makeGameboy(size):
+    data = makePayload(size)
+    romSize = 0
+    while (0x8000 << romSize) < size:
+        romSize += 1
+    logo = gameboy.GameboyParser.NINTENDO_LOGO
+    data[0x104 : 0x104 + len(logo)] = logo
+    data[0x134 : 0x150] = TITLE.encode().ljust(15, b"\x00") + b"\x80" + b"01\x00\x03" + \
+                          bytearray([romSize, 0x03, 0x01, 0x33, 0x00, 0x00, 0x00, 0x00])
+    return {"benchmark.gbc": data}
+
+def makeGBA(size):
+    data = makePayload(size)
+    logo = gba.GBAParser.NINTENDO_LOGO
+    data[0x04 : 0x04 + len(logo)] = logo
+    data[0xa0 : 0xc0] = TITLE.encode().ljust(12, b"\x00") + b"BNCE01\x96" + b"\x00" * 13
+    return {"benchmark.gba": data}
+
+# IP.BIN of the Dreamcast images, see DreamcastParser.parseBuffer()
+IP_BIN = testutils.makeIPBin(TITLE.encode())
+
+def makeCDI(size):
+    """
+    DiscJuggler (CDI v3) image: an audio session and a mode 2 data session
+    of about size bytes, with IP.BIN at the start of the data track.
+    """
+    sessions = [
+        [(0, 2, 2, 150, 0, b"")],
+        [(2, 1, 150, max(size // 2336, 1), 11702, b"\x00" * 8 + IP_BIN)],
+    ]
+    return {"benchmark.cdi": testutils.makeCDI(dreamcast.CDI_V3, sessions, makePayload)}
+
+def makeGDI(size):
+    """
+    GD-ROM dump (.gdi) whose high density data track is size bytes of raw
+    2352-byte mode 1 sectors, IP.BIN being in the first one.
+    """
+    sectors = max(size // 2352, 1)
+    sector = dreamcast.cd_sector_sync + b"\x00\x02\x00\x01"
+    user = makePayload(sectors * 2048)
+    user[ : len(IP_BIN)] = IP_BIN
+    track = bytearray()
+    for i in range(sectors):
+        track += sector + user[i * 2048 : (i + 1) * 2048] + b"\x00" * 288
+    gdi = "3\n1 0 4 2352 track01.bin 0\n2 756 0 2352 track02.raw 0\n3 45000 4 2352 track03.bin 0\n"
+    return {"benchmark.gdi": bytearray(gdi.encode()), "track03.bin": track}
+
+# (platform, variant, builder, image sizes of the size classes)
+CORPUS = [
+    ("snes", "lorom", lambda size: makeSNES(size), (0x80000, 0x200000, 0x400000)),
+    ("snes", "hirom", lambda size: makeSNES(size, "HiROM"), (0x80000, 0x200000, 0x400000)),
+    ("snes", "exhirom", lambda size: makeSNES(size, "ExHiROM"), (0x500000, 0x600000, 0x800000)),
+    ("snes", "smc-header", lambda size: makeSNES(size, copierHeader=True), (0x80000, 0x200000, 0x400000)),
+    ("snes", "interleaved", lambda size: makeSNES(size, "HiROM", interleaved=True), (0x80000, 0x200000, 0x400000)),
+    ("genesis", "bin", lambda size: makeGenesis(size), (0x80000, 0x100000, 0x400000)),
+    ("genesis", "smd", lambda size: makeGenesis(size, "smd"), (0x80000, 0x100000, 0x400000)),
+    ("genesis", "md", lambda size: makeGenesis(size, "md"), (0x80000, 0x100000, 0x400000)),
+    ("n64", "z64", lambda size: makeN64(size), (0x400000, 0x1000000, 0x2000000)),
+    ("n64", "v64", lambda size: makeN64(size, "v64"), (0x400000, 0x1000000, 0x2000000)),
+    ("n64", "n64", lambda size: makeN64(size, "n64"), (0x400000, 0x1000000, 0x2000000)),
+    ("nes", "ines", lambda size: makeNES(size), (0xa000, 0x40000, 0x100000)),
+    ("nes", "unif", lambda size: makeNES(size, "unif"), (0xa000, 0x40000, 0x100000)),
+    ("sms", "sdsc", makeSMS, (0x8000, 0x20000, 0x80000)),
+    ("gameboy", "gbc", makeGameboy, (0x8000, 0x40000, 0x200000)),
+    ("gba", "gba", makeGBA, (0x100000, 0x400000, 0x1000000)),
+    ("dreamcast", "cdi", makeCDI, (0x100000, 0x800000, 0x2000000)),
+    ("dreamcast", "gdi", makeGDI, (0x100000, 0x800000, 0x2000000)),
+]
+
+def writeCorpus(directory, sizeClasses=SIZE_CLASSES, platforms=None):
+    """
+    Write the corpus to directory, one subdirectory per image. Returns a list
+    of (platform, variant, size class, path to parse, total size in bytes).
+    Images that are already there (from an earlier run) are reused.
+    """
+    cases = []
+    for (platform, variant, builder, sizes) in CORPUS:
+        if platforms and platform not in platforms:
+            continue
+        for sizeClass in sizeClasses:
+            size = sizes[SIZE_CLASSES.index(sizeClass)]
+            caseDir = os.path.join(directory, "%s-%s-%s" % (platform, variant, sizeClass))
+            done = os.path.join(caseDir, ".done")
+            if not os.path.exists(done):
+                if not os.path.isdir(caseDir):
+                    os.makedirs(caseDir)
+                for (name, data) in builder(size).items():
+                    with open(os.path.join(caseDir, name), "wb") as f:
+                        f.write(data)
+                open(done, "w").close()
+            names = sorted(name for name in os.listdir(caseDir) if name.startswith("benchmark."))
+            total = sum(os.path.getsize(os.path.join(caseDir, name)) for name in os.listdir(caseDir)
+                        if name != ".done")
+            cases.append((platform, variant, sizeClass, os.path.join(caseDir, names[0]), total))
+    return cases
@@ -1,7 +1,25 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+import os
+import zipfile
+import collections
+import multiprocessing
+import multiprocessing.pool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from rominfo import RomInfoParser, RomView, _hooks, _emit, _clock, _callParser
+from archive import splitArchivePath, getDefaultMember, ZipMemberFile
+
+try:
+    StopAsyncIteration
+except NameError:
+    # Python 2, where trollius stands in for asyncio
+    class StopAsyncIteration(Exception):
+        pass
 
 __all__ = [
     "RomInfo",
@@ -16,22 +34,481 @@ __all__ = [
 
 class RomInfo(object):
     @staticmethod
-    def parse(filename):
-        ext = None
-        for parser in RomInfoParser.getParsers():
-            if not ext:
-                ext = parser._getExtension(filename)
-            if parser.isValidExtension(ext):
-                props = parser.parse(filename)
-                if props and any(props):
-                    return props
+    def parse(filename, cache=None, hashes=None, verify=False):
+        """
+        Parse a ROM file with the parsers that accept its extension. If no
+        parser accepts the extension, the file's contents are used to find
+        one. If a RomInfoCache is given, it is consulted first and updated
+        afterwards.
+
+        filename can also be a seekable binary file object, or name a zip
+        archive ("roms.zip", whose first member with a known extension is
+        parsed) or a member inside one ("roms.zip/Super Mario World.smc").
+        Members are streamed from the archive, and only inflated as far as the
+        parser reads.
+
+        hashes optionally names digests of the ROM to add to props, e.g.
+        ("crc32", "md5", "sha1"). They are computed in one streaming pass over
+        the image as normalized by the parser (without copier headers,
+        deinterleaved, in native byte order), see RomInfoParser.hashBuffer().
+
+        If verify is True, parsers that can (see RomInfoParser.canVerify())
+        check the image's checksums, which reads more of it.
+        """
+        if hasattr(filename, "read"):
+            return RomInfo._parseFileObject(filename, hashes, verify)
+        if cache is not None:
+            props = cache.get(filename, hashes or (), verify)
+            if props is None:
+                props = RomInfo.parse(filename, hashes=hashes, verify=verify)
+                cache.put(filename, props, verify)
+            return props
+        (archive, member) = splitArchivePath(filename)
+        if member is not None:
+            return RomInfo._parseArchive(archive, member, hashes, verify)
+        parsers = RomInfoParser.getParsersForExtension(RomInfoParser._getExtension(filename))
+        if not parsers:
+            return RomInfo._parseUnknown(filename, hashes, verify)
+        if _hooks:
+            _emit("dispatch", None, filename=filename, by="extension", parsers=parsers)
+        return RomInfo._parseWith(parsers, filename, hashes, verify)
+
+    @staticmethod
+    def parseBuffer(data, verify=False):
+        """
+        Parse a ROM image in memory: a bytearray, bytes, mmap, memoryview or a
+        seekable binary file object. data is only read, never modified. verify
+        works as in parse().
+        """
+        data = RomInfoParser._getView(data)
+        start = _clock() if _hooks else None
+        if _hooks:
+            _emit("dispatch", None, filename=None, by="contents", parsers=None)
+        tried = 0
+        for parser in RomInfoParser.getParsersForData(data):
+            tried += 1
+            props = _callParser(parser, parser.parseBuffer, data, verify=verify)
+            if props and any(props):
+                if _hooks:
+                    _emit("result", parser, filename=None, found=True, tried=tried, duration=_clock() - start)
+                return props
+        if _hooks:
+            _emit("result", None, filename=None, found=False, tried=tried, duration=_clock() - start)
+        return {}
+
+    @staticmethod
+    def _parseWith(parsers, filename, hashes=None, verify=False):
+        """
+        Parse filename (a name or a file object) with the first of parsers
+        that succeeds.
+        """
+        start = _clock() if _hooks else None
+        tried = 0
+        for parser in parsers:
+            tried += 1
+            props = _callParser(parser, parser.parse, filename, filename, verify)
+            if props and any(props):
+                if hashes:
+                    props.update(parser.hashFile(filename, hashes))
+                if _hooks:
+                    _emit("result", parser, filename=filename, found=True, tried=tried, duration=_clock() - start)
+                return props
+        if _hooks:
+            _emit("result", None, filename=filename, found=False, tried=tried, duration=_clock() - start)
         return {}
 
     @staticmethod
-    def parseBuffer(data):
-        for parser in RomInfoParser.getParsers():
-            if parser.isValidData(data):
-                props = parser.parseBuffer(data)
-                if props and any(props):
-                    return props
+    def _parseArchive(archive, member, hashes=None, verify=False):
+        """
+        Parse a member of a zip archive, or its default member (see
+        getDefaultMember()) if member is "". Parsers are picked by the
+        member's extension, or by its contents if that is unknown.
+        """
+        with zipfile.ZipFile(archive) as z:
+            if not member:
+                member = getDefaultMember(z)
+                if member is None:
+                    return {}
+            with ZipMemberFile(z, member) as f:
+                return RomInfo._parseFileObject(f, hashes, verify)
+
+    @staticmethod
+    def _parseFileObject(f, hashes=None, verify=False):
+        """
+        Parse a seekable binary file object. Parsers are picked by the
+        extension of its name attribute (if any), or by its contents.
+        """
+        parsers = RomInfoParser.getParsersForExtension(RomInfoParser._getExtension(f))
+        if parsers:
+            if _hooks:
+                _emit("dispatch", None, filename=f, by="extension", parsers=parsers)
+        else:
+            if _hooks:
+                _emit("dispatch", None, filename=f, by="contents", parsers=None)
+            data = RomView(RomInfoParser._instrumentFile(f, None))
+            parsers = RomInfoParser.getParsersForData(data, probe=False) if len(data) else ()
+        return RomInfo._parseWith(parsers, f, hashes, verify)
+
+    @staticmethod
+    def _parseUnknown(filename, hashes=None, verify=False):
+        """
+        Sniff the contents of a file whose extension is unknown (or missing),
+        and parse it with the first parser whose signature they match (see
+        getParsersForData()). Signatures are checked on a RomView, so only the
+        pages holding them are read.
+        """
+        start = _clock() if _hooks else None
+        if _hooks:
+            _emit("dispatch", None, filename=filename, by="contents", parsers=None)
+        tried = 0
+        # Missing files and directories are a miss, as before files of
+        # unknown type were sniffed
+        if os.path.isfile(filename):
+            with open(filename, "rb") as f:
+                data = RomView(RomInfoParser._instrumentFile(f, None))
+                if len(data):
+                    for parser in RomInfoParser.getParsersForData(data, probe=False):
+                        tried += 1
+                        props = _callParser(parser, parser.parse, filename, filename, verify)
+                        if props and any(props):
+                            if hashes:
+                                props.update(parser.hashBuffer(data, hashes))
+                            if _hooks:
+                                _emit("result", parser, filename=filename, found=True, tried=tried,
+                                      duration=_clock() - start)
+                            return props
+        if _hooks:
+            _emit("result", None, filename=filename, found=False, tried=tried, duration=_clock() - start)
         return {}
+
+    @staticmethod
+    def scan(paths, workers=None, executor="thread", onError=None, maxPending=None, cache=None,
+             hashes=None, verify=False):
+        """
+        Parse every file in paths (a file or directory name, or a list of them;
+        directories are walked recursively) on a pool of workers, yielding
+        (path, props) tuples as the files are parsed, in no particular order.
+
+        executor is "thread" or "process", and workers defaults to the number
+        of CPUs. At most maxPending files (default: 4 per worker) are queued
+        at a time. A file that fails to parse yields empty props, and the
+        exception is passed to onError(path, exc) if given.
+
+        If a RomInfoCache is given, files found in it are yielded right away
+        instead of being parsed, and parse results are added to it. hashes and
+        verify are passed on to RomInfo.parse().
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if maxPending is None:
+            maxPending = 4 * workers
+        if executor == "thread":
+            pool = multiprocessing.pool.ThreadPool(workers)
+        elif executor == "process":
+            # Workers need the same parsers registered
+            modules = [type(parser).__module__ for parser in RomInfoParser.getParsers()]
+            pool = multiprocessing.Pool(workers, _initWorker, (modules,))
+        else:
+            raise ValueError("Unknown executor: %s" % executor)
+
+        # Results are queued by the tasks' callbacks, tagged with the task's
+        # number. Tasks that fail in the pool (e.g. when their result can't
+        # be pickled) never call back, so pending is polled for them.
+        results = queue.Queue()
+        pending = {}
+        try:
+            for (task, path) in enumerate(_iterFiles(paths)):
+                if cache is not None:
+                    props = cache.get(path, hashes or (), verify)
+                    if props is not None:
+                        yield (path, props)
+                        continue
+                callback = lambda result, task=task: results.put((task, result))
+                pending[task] = (path, pool.apply_async(_parseFile, (path, hashes, verify), callback=callback))
+                while len(pending) >= maxPending or (pending and not results.empty()):
+                    yield _getResult(_waitResult(results, pending), onError, cache, verify)
+            while pending:
+                yield _getResult(_waitResult(results, pending), onError, cache, verify)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def aparse(filename, cache=None, hashes=None, executor=None, semaphore=None, loop=None,
+               verify=False):
+        """
+        Asynchronous RomInfo.parse(): return an asyncio future of filename's
+        props, e.g. props = await RomInfo.aparse(filename). The file is read
+        and parsed on executor (a concurrent.futures executor, by default the
+        loop's), so the event loop never blocks on it. A process pool suits
+        CPU-bound images; its workers must have the same parsers registered.
+
+        If an asyncio.Semaphore is given, it is held while the file is parsed,
+        which caps the parses in flight across every call sharing it.
+        Cancelling the future cancels the wait for the semaphore and, if the
+        executor hasn't started it yet, the parse.
+
+        A RomInfoCache is only used from the loop's thread. hashes and verify
+        work as in parse().
+        """
+        asyncio = _getAsyncio()
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if cache is not None:
+            props = cache.get(filename, hashes or (), verify)
+            if props is not None:
+                result = asyncio.Future(loop=loop)
+                result.set_result(props)
+                return result
+        result = _runInExecutor(loop, executor, semaphore, _parsePath, filename, hashes, verify)
+        if cache is not None:
+            def putProps(result):
+                if not result.cancelled() and result.exception() is None:
+                    cache.put(filename, result.result(), verify)
+            result.add_done_callback(putProps)
+        return result
+
+    @staticmethod
+    def ascan(paths, executor=None, semaphore=None, onError=None, maxPending=None, cache=None,
+              hashes=None, loop=None, verify=False):
+        """
+        Asynchronous RomInfo.scan(): return an asynchronous iterator of
+        (path, props) tuples, e.g. async for path, props in RomInfo.ascan(roots).
+        Directories are walked and files parsed on executor (see aparse()),
+        holding semaphore (if given) around each parse. At most maxPending
+        files (default: 4 per CPU) are parsed or waiting to be consumed at a
+        time. onError, cache, hashes and verify work as in scan().
+
+        Call cancel() on the iterator to stop the scan, which also happens if
+        the task waiting for the next result is cancelled. On Python 2, the
+        end of the scan is signalled by pyrominfo.StopAsyncIteration.
+        """
+        if maxPending is None:
+            maxPending = 4 * multiprocessing.cpu_count()
+        return _AsyncScan(paths, executor, semaphore, onError, maxPending, cache, hashes, verify, loop)
+
+def _iterFiles(paths):
+    if isinstance(paths, str) or not hasattr(paths, "__iter__"):
+        paths = [paths]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+def _initWorker(modules):
+    for module in modules:
+        __import__(module)
+
+def _parseFile(path, hashes, verify=False):
+    try:
+        return (path, RomInfo.parse(path, hashes=hashes, verify=verify), None)
+    except Exception as e:
+        return (path, {}, e)
+
+def _waitResult(results, pending):
+    """
+    Wait for the next (path, props, error) result of the tasks in pending,
+    a dict of (path, AsyncResult) by task number, and remove its task.
+    """
+    while True:
+        try:
+            (task, result) = results.get(timeout=0.5)
+            del pending[task]
+            return result
+        except queue.Empty:
+            pass
+        for (task, (path, result)) in list(pending.items()):
+            # ready() is only set after the callback of a successful task ran
+            if result.ready() and not result.successful():
+                del pending[task]
+                try:
+                    result.get()
+                except Exception as e:
+                    return (path, {}, e)
+
+def _getResult(result, onError, cache, verify=False):
+    (path, props, error) = result
+    if error is not None:
+        if onError:
+            onError(path, error)
+    elif cache is not None:
+        cache.put(path, props, verify)
+    return (path, props)
+
+def _getAsyncio():
+    try:
+        import asyncio
+    except ImportError:
+        try:
+            import trollius as asyncio
+        except ImportError:
+            raise ImportError("The asynchronous API needs asyncio (trollius on Python 2)")
+    return asyncio
+
+def _listFiles(paths):
+    return list(_iterFiles(paths))
+
+def _parsePath(path, hashes, verify=False):
+    return RomInfo.parse(path, hashes=hashes, verify=verify)
+
+def _runInExecutor(loop, executor, semaphore, func, *args):
+    """
+    Call func(*args) on executor, holding semaphore (if not None) meanwhile,
+    and return a future of its result. Cancelling the future cancels the wait
+    for the semaphore, and the call if it hasn't started.
+    """
+    asyncio = _getAsyncio()
+    result = asyncio.Future(loop=loop)
+
+    def finish(call):
+        if semaphore is not None:
+            semaphore.release()
+        if result.cancelled():
+            return
+        if call.cancelled():
+            result.cancel()
+        elif call.exception() is not None:
+            result.set_exception(call.exception())
+        else:
+            result.set_result(call.result())
+
+    def start(acquired=None):
+        if acquired is not None and acquired.cancelled():
+            return
+        if result.cancelled():
+            if acquired is not None:
+                semaphore.release()
+            return
+        call = loop.run_in_executor(executor, func, *args)
+        call.add_done_callback(finish)
+        result.add_done_callback(lambda result: result.cancelled() and call.cancel())
+
+    if semaphore is None:
+        start()
+    else:
+        acquire = asyncio.ensure_future(semaphore.acquire(), loop=loop)
+        acquire.add_done_callback(start)
+        result.add_done_callback(lambda result: result.cancelled() and acquire.cancel())
+    return result
+
+
+class _AsyncScan(object):
+    """
+    Asynchronous iterator returned by RomInfo.ascan(). All of its state is
+    only touched from the loop's thread, in future callbacks.
+    """
+    def __init__(self, paths, executor, semaphore, onError, maxPending, cache, hashes, verify, loop):
+        self.asyncio = _getAsyncio()
+        self.loop = loop or self.asyncio.get_event_loop()
+        self.paths = paths
+        self.executor = executor
+        self.semaphore = semaphore
+        self.onError = onError
+        self.maxPending = maxPending
+        self.cache = cache
+        self.hashes = hashes
+        self.verify = verify
+        # Future of the list of files, then an iterator over it
+        self.listing = None
+        self.files = None
+        # Paths of the files being parsed by future, and (path, props) not yet
+        # consumed
+        self.running = {}
+        self.results = collections.deque()
+        # Future returned by __anext__(), until it gets a result
+        self.waiter = None
+        self.cancelled = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        waiter = self.asyncio.Future(loop=self.loop)
+        if self.cancelled:
+            waiter.cancel()
+            return waiter
+        waiter.add_done_callback(self._waiterDone)
+        self.waiter = waiter
+        if self.listing is None:
+            self.listing = _runInExecutor(self.loop, self.executor, None, _listFiles, self.paths)
+            self.listing.add_done_callback(self._listed)
+        else:
+            self._update()
+        return waiter
+
+    def cancel(self):
+        """
+        Stop the scan: cancel the parses that haven't started, and the pending
+        __anext__() future. Parses already running are left to finish, but
+        their results are dropped.
+        """
+        self.cancelled = True
+        self.files = iter(())
+        self.results.clear()
+        if self.listing is not None:
+            self.listing.cancel()
+        for future in list(self.running):
+            future.cancel()
+        if self.waiter is not None:
+            self.waiter.cancel()
+
+    def _waiterDone(self, waiter):
+        if waiter is self.waiter:
+            self.waiter = None
+        if waiter.cancelled() and not self.cancelled:
+            self.cancel()
+
+    def _listed(self, listing):
+        if listing.cancelled():
+            return
+        if listing.exception() is not None:
+            self.files = iter(())
+            if self.waiter is not None:
+                self.waiter.set_exception(listing.exception())
+            return
+        self.files = iter(listing.result())
+        self._update()
+
+    def _parsed(self, future):
+        path = self.running.pop(future, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # _parseFile() catches parse errors, so the executor failed (e.g.
+            # a broken process pool). Report it like a parse error.
+            result = (path, {}, future.exception())
+        else:
+            result = future.result()
+        self.results.append(_getResult(result, self.onError, self.cache, self.verify))
+        self._update()
+
+    def _update(self):
+        """
+        Start parsing files until maxPending are in flight, and hand a result
+        to the waiting __anext__() future, if any.
+        """
+        if self.files is None:
+            return
+        while len(self.running) + len(self.results) < self.maxPending:
+            path = next(self.files, None)
+            if path is None:
+                break
+            if self.cache is not None:
+                props = self.cache.get(path, self.hashes or (), self.verify)
+                if props is not None:
+                    self.results.append((path, props))
+                    continue
+            future = _runInExecutor(self.loop, self.executor, self.semaphore, _parseFile, path,
+                                    self.hashes, self.verify)
+            self.running[future] = path
+            future.add_done_callback(self._parsed)
+        if self.waiter is None or self.waiter.done():
+            return
+        if self.results:
+            self.waiter.set_result(self.results.popleft())
+        elif not self.running:
+            self.waiter.set_exception(StopAsyncIteration())
@@ -0,0 +1,107 @@
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import os
+import zipfile
+
+from rominfo import RomInfoParser
+
+def splitArchivePath(path):
+    """
+    Split a path into (archive, member) if it names a zip archive or a member
+    inside one, e.g. "roms.zip/Super Mario World.smc". member is "" for the
+    archive itself. Returns (path, None) for other paths.
+    """
+    normalized = path.replace(os.sep, "/")
+    lower = normalized.lower()
+    pos = lower.find(".zip/")
+    while pos != -1:
+        archive = path[ : pos + 4]
+        if os.path.isfile(archive):
+            return (archive, normalized[pos + 5 : ])
+        pos = lower.find(".zip/", pos + 1)
+    if lower.endswith(".zip") and os.path.isfile(path) and zipfile.is_zipfile(path):
+        return (path, "")
+    return (path, None)
+
+def getDefaultMember(archive):
+    """
+    Return the name of the first member of archive (a ZipFile) with an
+    extension claimed by a parser, or else its first file. None if it has no
+    files.
+    """
+    names = [info.filename for info in archive.infolist() if not info.filename.endswith("/")]
+    for name in names:
+        if RomInfoParser.getParsersForExtension(RomInfoParser._getExtension(name)):
+            return name
+    return names[0] if names else None
+
+
+class ZipMemberFile(object):
+    """
+    Seekable, read-only file object for a member of a zip archive, which is
+    given as a ZipFile. The member is inflated lazily, only as far as it is
+    read: seeking forward inflates and discards the bytes skipped, seeking
+    backward starts over from the beginning of the member. Reading through a
+    RomView keeps the latter rare, as pages are only read once.
+    """
+
+    # Bytes inflated at a time when skipping forward
+    SKIP_SIZE = 0x10000
+
+    def __init__(self, archive, member):
+        self.archive = archive
+        self.info = archive.getinfo(member)
+        self.name = member
+        self.size = self.info.file_size
+        self.pos = 0
+        self.stream = None
+        # Number of bytes inflated from stream
+        self.streamPos = 0
+
+    def read(self, size=-1):
+        if size < 0 or self.pos + size > self.size:
+            size = max(self.size - self.pos, 0)
+        self._seekStream()
+        data = self.stream.read(size)
+        self.pos += len(data)
+        self.streamPos = self.pos
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[ : len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _seekStream(self):
+        if self.stream is None or self.pos < self.streamPos:
+            self.close()
+            self.stream = self.archive.open(self.info)
+            self.streamPos = 0
+        while self.streamPos < self.pos:
+            skipped = len(self.stream.read(min(self.pos - self.streamPos, self.SKIP_SIZE)))
+            if not skipped:
+                break
+            self.streamPos += skipped
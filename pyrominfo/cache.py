@@ -0,0 +1,132 @@
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import os
+import sys
+import pickle
+import hashlib
+import sqlite3
+
+from rominfo import RomInfoParser
+from archive import splitArchivePath
+
+class RomInfoCache(object):
+    """
+    On-disk (SQLite) cache of parsed ROM info, keyed by the file's path, size,
+    modification time and the version of the registered parsers. Entries
+    parsed with verify=True also serve lookups without it, but not the other
+    way around. Pass it to
+    RomInfo.parse() or RomInfo.scan() to skip files that haven't changed:
+
+        cache = RomInfoCache("roms.db", maxEntries=200000)
+        for path, props in RomInfo.scan("/roms", cache=cache):
+            ...
+        cache.close()
+
+    The parser version defaults to a hash of the source of the registered
+    parser modules, so entries are dropped when a parser changes. When
+    maxEntries is given, the least recently used entries are evicted when
+    changes are committed. A cache must only be used from one thread.
+    """
+
+    # Writes (including access times of hits) are committed in batches
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, filename, maxEntries=None, version=None):
+        self.maxEntries = maxEntries
+        self.version = version if version is not None else getParserVersion()
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS roms (path TEXT PRIMARY KEY, size INTEGER, "
+                        "mtime INTEGER, version TEXT, props BLOB, accessed INTEGER, verified INTEGER)")
+        if "verified" not in [row[1] for row in self.db.execute("PRAGMA table_info(roms)")]:
+            # Caches created before verify was cached hold unverified entries
+            self.db.execute("ALTER TABLE roms ADD COLUMN verified INTEGER DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS roms_accessed ON roms (accessed)")
+        self.db.execute("DELETE FROM roms WHERE version != ?", (self.version,))
+        self.db.commit()
+        self.clock = self.db.execute("SELECT MAX(accessed) FROM roms").fetchone()[0] or 0
+        self.uncommitted = 0
+
+    def get(self, filename, hashes=(), verify=False):
+        """
+        Return the cached props of filename, or None if the file isn't cached,
+        has changed since, or was cached without one of the given hashes or
+        without verify (see RomInfo.parse()).
+        """
+        key = self._getKey(filename)
+        if key is None:
+            return None
+        row = self.db.execute("SELECT size, mtime, version, props, verified FROM roms WHERE path = ?",
+                              (key[0],)).fetchone()
+        if row is None or tuple(row[ : 3]) != key[1 : ] or (verify and not row[4]):
+            return None
+        props = pickle.loads(bytes(row[3]))
+        if props and any(name not in props for name in hashes):
+            return None
+        self.clock += 1
+        self.db.execute("UPDATE roms SET accessed = ? WHERE path = ?", (self.clock, key[0]))
+        self._wrote()
+        return props
+
+    def put(self, filename, props, verify=False):
+        key = self._getKey(filename)
+        if key is None:
+            return
+        self.clock += 1
+        self.db.execute("INSERT OR REPLACE INTO roms VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        key + (sqlite3.Binary(pickle.dumps(props, 2)), self.clock, int(bool(verify))))
+        self._wrote()
+
+    def commit(self):
+        if self.maxEntries is not None:
+            self.db.execute("DELETE FROM roms WHERE path IN (SELECT path FROM roms "
+                            "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.maxEntries,))
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM roms").fetchone()[0]
+
+    def _getKey(self, filename):
+        # Members of a zip archive change with the archive
+        try:
+            st = os.stat(splitArchivePath(filename)[0])
+        except OSError:
+            return None
+        mtime = getattr(st, "st_mtime_ns", None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        return (os.path.abspath(filename), st.st_size, mtime, self.version)
+
+    def _wrote(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.commit()
+
+def getParserVersion():
+    """
+    Hash the source files of the registered parsers' modules, and of the
+    module defining RomInfoParser.
+    """
+    names = set(type(parser).__module__ for parser in RomInfoParser.getParsers())
+    names.add(RomInfoParser.__module__)
+    digest = hashlib.sha1()
+    for name in sorted(names):
+        filename = getattr(sys.modules.get(name), "__file__", None) or ""
+        if filename[-4 : ] in (".pyc", ".pyo") and os.path.exists(filename[ : -1]):
+            filename = filename[ : -1]
+        digest.update(name.encode("utf-8"))
+        if os.path.isfile(filename):
+            with open(filename, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
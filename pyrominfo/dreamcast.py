@@ -2,10 +2,12 @@
 # See Copyright Notice in rominfo.py
 
 import os
-import csv
+import shlex
 import struct
 import time
 import datetime
+import threading
+import collections
 from rominfo import RomInfoParser
 
 
@@ -23,36 +25,53 @@ class DreamcastParser(RomInfoParser):
     * https://www.dropbox.com/s/ithnw69wy3ciuzn/IP0000.BIN.txt
     """
 
+    # Number of .gdi track tables kept, see _get_gdi_tracks()
+    GDI_CACHE_SIZE = 64
+
+    def __init__(self):
+        # Parsed .gdi track tables, least recently used first. The registered
+        # parser is shared by the threads of a scan, hence the lock.
+        self._gdi_tracks = collections.OrderedDict()
+        self._gdi_lock = threading.Lock()
+
     def getValidExtensions(self):
         # TODO: Improve cdi support
         # TODO: Add chd support
         return ["cdi", "gdi"]
 
     def parse(self, filename):
-        ext = os.path.splitext(filename)[1].lower()
+        ext = self._getExtension(filename)
         data = None
-        if ext == '.cdi':
-            data = self._parse_cdi(filename)
-        elif ext == '.gdi':
-            data = self._parse_gdi(filename)
+        tracks = None
+        if ext == 'cdi' or (ext != 'gdi' and hasattr(filename, 'read')):
+            # File objects without a name can only be CDI images, which are
+            # recognized by their trailer
+            data, tracks = self._parse_cdi(filename) or (None, None)
+        elif ext == 'gdi' and hasattr(filename, 'read'):
+            # Track files are looked up next to the .gdi file
+            print("GDI images must be read from disk")
+        elif ext == 'gdi':
+            data, tracks = self._parse_gdi(filename) or (None, None)
         else:
             print("Unknown image format")
 
         if data is None:
             return {}
-        else:
-            return self.parseBuffer(data)
+        props = self.parseBuffer(data)
+        if props and tracks is not None:
+            props['tracks'] = tuple(dict(t) for t in tracks)
+        return props
 
     def _parse_cdi(self, filename):
-        file_size = os.path.getsize(filename)
-        if file_size < 8:
-            print("Image size too short")
-            return None
+        with self._open(filename) as f:
+            f.seek(0, 2)
+            file_size = f.tell()
+            if file_size < 8:
+                print("Image size too short")
+                return None
 
-        with open(filename, mode="rb") as f:
             f.seek(file_size-8)
-            image_version = struct.unpack("<I", f.read(4))[0]
-            image_header_offset = struct.unpack("<I", f.read(4))[0]
+            image_version, image_header_offset = cdi_trailer.unpack(f.read(8))
 
             if image_header_offset == 0:
                 print("Bad image format")
@@ -62,117 +81,239 @@ class DreamcastParser(RomInfoParser):
                 print("Unsupported CDI version!")
                 return None
 
+            # The session and track descriptors run up to the trailer, so they
+            # are read in one go. Version 3.5 counts the offset from the end.
+            if image_version == CDI_V35:
+                image_header_offset = file_size - image_header_offset
+            if not 0 <= image_header_offset < file_size or \
+                    file_size - image_header_offset > cdi_max_descriptors:
+                # Corrupt offsets mustn't read the image into memory
+                print("Bad image format")
+                return None
             f.seek(image_header_offset)
-            num_sessions = struct.unpack("<H", f.read(2))[0]
-
-            last_data_track_info = (None, None)
-            track_offset = 0
-            for s in range(num_sessions):
-                num_tracks = struct.unpack("<H", f.read(2))[0]
+            block = f.read(file_size - image_header_offset)
 
-                for t in range(num_tracks):
-                    temp_value = struct.unpack("<I", f.read(4))[0]
-                    if temp_value != 0:
-                        # extra data (DJ 3.00.780 and up)
-                        f.seek(8, 1)
-
-                    current_start_mark = struct.unpack("<10B", f.read(10))
-                    if current_start_mark != cdi_track_start_mark:
-                        print("Unsupported format: Missing track start mark")
-                        return None
-
-                    current_start_mark = struct.unpack("<10B", f.read(10))
-                    if current_start_mark != cdi_track_start_mark:
-                        print("Unsupported format: Missing track start mark")
-                        return None
-
-                    f.seek(4, 1)
-                    filename_length = struct.unpack("<B", f.read(1))[0]
-                    filename = f.read(filename_length).decode('utf-8')
-
-                    f.seek(11, 1)
-                    f.seek(4, 1)
-                    f.seek(4, 1)
-                    temp_value = struct.unpack("<I", f.read(4))[0]
-                    if temp_value == 0x80000000:
-                        # DiscJuggler 4
-                        f.seek(8, 1)
-                    f.seek(2, 1)
-                    track_pregap_length = struct.unpack("<I", f.read(4))[0]
-                    track_length = struct.unpack("<I", f.read(4))[0]
-                    f.seek(6, 1)
-                    track_mode = struct.unpack("<I", f.read(4))[0]
-                    f.seek(12, 1)
-                    track_start_lba = struct.unpack("<I", f.read(4))[0]
-                    track_total_length = struct.unpack("<I", f.read(4))[0]
-                    f.seek(16, 1)
-                    sector_size_id = struct.unpack("<I", f.read(4))[0]
-
-                    if sector_size_id not in cdi_track_sector_sizes:
-                        print("Unsupported sector size")
-                        return
-                    track_sector_size = cdi_track_sector_sizes[sector_size_id]
-
-                    if track_mode not in cdi_track_modes:
-                        print("Unsupported format: Track mode not supported")
-                    elif track_mode > 0:
-                        track_position = (track_offset + track_pregap_length *
-                                          track_sector_size)
-                        last_data_track_info = (track_position,
-                                                track_sector_size)
-
-                    track_offset += track_total_length * track_sector_size
-
-                    f.seek(29, 1)
-                    if image_version != CDI_V2:
-                        f.seek(5, 1)
-                        temp_value = struct.unpack("<I", f.read(4))[0]
-                        if temp_value == 0xffffffff:
-                            # extra data (DJ 3.00.780 and up)
-                            f.seek(78, 1)
-
-                # Skip to next session
-                f.seek(4, 1)
-                f.seek(8, 1)
-                if image_version != CDI_V2:
-                    f.seek(1, 1)
+            try:
+                tracks = self._parse_cdi_tracks(block, image_version)
+            except struct.error:
+                print("Bad image format")
+                return None
+            if tracks is None:
+                return None
 
             # Extract IP.BIN data
-            if last_data_track_info == (None, None):
+            data_tracks = [t for t in tracks if t['mode'] in ('mode1', 'mode2')]
+            if not data_tracks:
                 print("Unsupported Image: Data track not found")
-                return
+                return None
 
-            ip_bin_position = last_data_track_info[0]
-            if last_data_track_info[1] == 2336:
+            ip_bin_position = data_tracks[-1]['offset']
+            if data_tracks[-1]['sector_size'] == 2336:
                 ip_bin_position += 8
             f.seek(ip_bin_position)
             data = f.read(256)
 
-            return data
+            return data, tracks
+
+    def _parse_cdi_tracks(self, block, image_version):
+        """
+        Decode the session and track descriptors in block. Returns the track
+        table, a list with a dict per track giving its index, session, mode,
+        sector size, start LBA, pregap and length (in sectors), and the file
+        offset of its data (after the pregap).
+        """
+        pos = 0
+        num_sessions = cdi_uint16.unpack_from(block, pos)[0]
+        pos += 2
+
+        tracks = []
+        track_offset = 0
+        for s in range(num_sessions):
+            num_tracks = cdi_uint16.unpack_from(block, pos)[0]
+            pos += 2
+
+            for t in range(num_tracks):
+                if cdi_uint32.unpack_from(block, pos)[0] != 0:
+                    # extra data (DJ 3.00.780 and up)
+                    pos += 8
+                pos += 4
+
+                if block[pos:pos + 20] != cdi_track_start_marks:
+                    print("Unsupported format: Missing track start mark")
+                    return None
+                pos += 20
+
+                pos += 4
+                filename_length = cdi_uint8.unpack_from(block, pos)[0]
+                pos += 1 + filename_length
+
+                pos += 11 + 4 + 4
+                if cdi_uint32.unpack_from(block, pos)[0] == 0x80000000:
+                    # DiscJuggler 4
+                    pos += 8
+                pos += 4
+
+                (track_pregap_length, track_length, track_mode,
+                 track_start_lba, track_total_length,
+                 sector_size_id) = cdi_track_info.unpack_from(block, pos)
+                pos += cdi_track_info.size
+
+                if sector_size_id not in cdi_track_sector_sizes:
+                    print("Unsupported sector size")
+                    return None
+                track_sector_size = cdi_track_sector_sizes[sector_size_id]
+
+                if track_mode not in cdi_track_modes:
+                    print("Unsupported format: Track mode not supported")
+
+                tracks.append({
+                    'index': len(tracks) + 1,
+                    'session': s + 1,
+                    'mode': cdi_track_modes.get(track_mode),
+                    'sector_size': track_sector_size,
+                    'lba': track_start_lba,
+                    'pregap': track_pregap_length,
+                    'length': track_length,
+                    'offset': (track_offset + track_pregap_length *
+                               track_sector_size),
+                })
+
+                track_offset += track_total_length * track_sector_size
+
+                pos += 29
+                if image_version != CDI_V2:
+                    pos += 5
+                    if cdi_uint32.unpack_from(block, pos)[0] == 0xffffffff:
+                        # extra data (DJ 3.00.780 and up)
+                        pos += 78
+                    pos += 4
+
+            # Skip to next session
+            pos += 4 + 8
+            if image_version != CDI_V2:
+                pos += 1
+
+        return tracks
 
     def _parse_gdi(self, filename):
+        tracks = self._get_gdi_tracks(filename)
+        if tracks is None:
+            return None
+        if len(tracks) < 3:
+            print("GDI images should have at least 3 tracks!")
+        track = [t for t in tracks if t['index'] == 3]
+        if not track:
+            return None
+        if track[0]['mode'] == 'audio':
+            print("Track 3 should be a data track, but it isn't!")
+            return None
+        # Extract IP.BIN data
+        try:
+            data = self._read_user_data(track[0], 0)[:256]
+        except (IOError, OSError):
+            print("Unable to read track 3")
+            return None
+        return data, tracks
+
+    def _get_gdi_tracks(self, filename):
+        """
+        Return the track table of a .gdi file, a list with a dict per track
+        giving its index, start LBA, mode, sector size, file and the offset of
+        its data in the file. The last GDI_CACHE_SIZE tables used are cached
+        until their .gdi file changes.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = (st.st_size, st.st_mtime)
+        with self._gdi_lock:
+            cached = self._gdi_tracks.pop(filename, None)
+            if cached is not None and cached[0] == key:
+                self._gdi_tracks[filename] = cached
+                return cached[1]
+
+        tracks = []
         with open(filename, mode="r") as f:
-            num_tracks = int(f.readline().strip())
-            if num_tracks < 3:
-                print("GDI images should have at least 3 tracks!")
-            gdi_reader = csv.reader(f, delimiter=' ', quotechar='"')
-            for row in gdi_reader:
-                track_index = int(row[0])
-                track_ctrl = int(row[2])
-                track_mode = 0 if track_ctrl == 0 else 1
-                track_filename = os.path.abspath(os.path.join(
-                    os.path.dirname(filename), row[4]))
-                if track_index == 3:
-                    break
-        if track_index == 3:
-            if track_mode == 0:
-                print("Track 3 should be a data track, but it isn't!")
-            else:
-                # Extract IP.BIN data
-                with open(track_filename, mode="rb") as f:
-                    ip_bin_position = 0x10
-                    f.seek(ip_bin_position)
-                    return f.read(256)
+            try:
+                num_tracks = int(f.readline().strip())
+            except ValueError:
+                print("Bad GDI format")
+                return None
+            for line in f:
+                try:
+                    row = self._split_gdi_line(line)
+                    if not row:
+                        continue
+                    track_ctrl = int(row[2])
+                    tracks.append({
+                        'index': int(row[0]),
+                        'lba': int(row[1]),
+                        'mode': 'audio' if track_ctrl == 0 else 'mode1',
+                        'sector_size': int(row[3]),
+                        'file': os.path.join(os.path.dirname(filename),
+                                             row[4]),
+                        'offset': int(row[5]) if len(row) > 5 else 0,
+                    })
+                except (IndexError, ValueError):
+                    print("Bad GDI format")
+                    return None
+        if len(tracks) != num_tracks:
+            print("GDI track count doesn't match its track list")
+
+        with self._gdi_lock:
+            self._gdi_tracks[filename] = (key, tracks)
+            while len(self._gdi_tracks) > self.GDI_CACHE_SIZE:
+                self._gdi_tracks.popitem(last=False)
+        return tracks
+
+    def _split_gdi_line(self, line):
+        """
+        Split a line of a .gdi file into its fields. Fields may be padded
+        with several spaces, and the file name may be double-quoted. Unquoted
+        names are taken as they are, apostrophes, backslashes and # included.
+        Raises ValueError on an unterminated quote.
+        """
+        lexer = shlex.shlex(line, posix=True)
+        lexer.whitespace_split = True
+        lexer.quotes = '"'
+        lexer.escape = ''
+        lexer.commenters = ''
+        return list(lexer)
+
+    def _read_user_data(self, track, sector, count=1):
+        """
+        Read the 2048-byte user data of count sectors of a track, starting at
+        the track's sector-th sector. Raw 2352-byte and 2336-byte sectors are
+        stripped of their sync pattern, headers and error correction codes.
+        """
+        sector_size = track['sector_size']
+        with self._open(track['file']) as f:
+            f.seek(track['offset'] + sector * sector_size)
+            raw = f.read(count * sector_size)
+        if sector_size == 2048:
+            return raw
+        blocks = []
+        for pos in range(0, len(raw), sector_size):
+            blocks.append(raw[pos + self._get_user_data_offset(raw[pos:pos + 16], sector_size):][:2048])
+        return b"".join(blocks)
+
+    def _get_user_data_offset(self, header, sector_size):
+        """
+        Return the position of the user data in a sector of sector_size bytes
+        starting with header (its first 16 bytes).
+        """
+        if sector_size == 2336:
+            # Mode 2 without sync and header, user data follows the subheader
+            return 8
+        if sector_size == 2352:
+            # 12 sync bytes, 3 address bytes and a mode byte. Mode 2 (XA)
+            # sectors have an 8-byte subheader before the user data.
+            if header[:12] == cd_sector_sync and bytearray(header)[15] == 2:
+                return 24
+            return 16
+        return 0
 
     def parseBuffer(self, data):
         # See SEGA's GD-ROM Format Basic Specifications Ver. 2.13, p. 13 for
@@ -180,7 +321,7 @@ class DreamcastParser(RomInfoParser):
         fmt = "<16s16s5s11s8s8s10s6s8s8x12s4x16s96s32x"
         try:
             ip_info = (s.decode('ascii').strip() for s in
-                       struct.unpack(fmt, data))
+                       struct.unpack(fmt, bytes(bytearray(data[:256]))))
         except (struct.error, UnicodeDecodeError):
             return {}
         keys = ('hardware_id',
@@ -222,11 +363,30 @@ CDI_V3 = 0x80000005
 CDI_V35 = 0x80000006
 
 cdi_track_start_mark = (0, 0, 0x01, 0, 0, 0, 0xFF, 0xFF, 0xFF, 0xFF)
+# Each track descriptor has the start mark twice
+cdi_track_start_marks = struct.pack("<10B", *cdi_track_start_mark) * 2
+
+# Descriptors are decoded with these precompiled structs
+cdi_uint8 = struct.Struct("<B")
+cdi_uint16 = struct.Struct("<H")
+cdi_uint32 = struct.Struct("<I")
+# Image version and descriptor offset, in the last 8 bytes of the image
+cdi_trailer = struct.Struct("<II")
+# Pregap length, length, mode, start LBA, total length and sector size id
+cdi_track_info = struct.Struct("<2xII6xI12xII16xI")
+# Longest track descriptor, with a 255-byte file name and every optional field
+cdi_max_track_descriptor = 8 + 4 + 20 + 4 + 1 + 255 + 19 + 8 + 4 + cdi_track_info.size + 29 + 5 + 78 + 4
+# Longest descriptor block, trailer included: a disc has at most 99 tracks,
+# at worst each in a session of its own
+cdi_max_descriptors = 2 + 99 * (2 + cdi_max_track_descriptor + 4 + 8 + 1) + cdi_trailer.size
 cdi_track_sector_sizes = {
     0: 2048,
     1: 2336,
     2: 2352
 }
+# Sync pattern at the start of raw (2352-byte) sectors
+cd_sector_sync = b"\x00" + b"\xff" * 10 + b"\x00"
+
 cdi_track_modes = {
     0: 'audio',
     1: 'mode1',
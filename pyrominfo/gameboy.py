@@ -1,7 +1,7 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+from rominfo import RomInfoParser, RomView
 
 class GameboyParser(RomInfoParser):
     """
@@ -13,15 +13,29 @@ class GameboyParser(RomInfoParser):
     * http://sourceforge.net/p/vbam/code/HEAD/tree/trunk/src/win32/RomInfo.cpp
     """
 
+    # Nintendo logo at 0104-0133, see isValidData()
+    NINTENDO_LOGO = bytes(bytearray([
+        0xCE, 0xED, 0x66, 0x66, 0xCC, 0x0D, 0x00, 0x0B, 0x03, 0x73, 0x00, 0x83, 0x00, 0x0C, 0x00, 0x0D,
+        0x00, 0x08, 0x11, 0x1F, 0x88, 0x89, 0x00, 0x0E, 0xDC, 0xCC, 0x6E, 0xE6, 0xDD, 0xDD, 0xD9, 0x99,
+        0xBB, 0xBB, 0x67, 0x63, 0x6E, 0x0E, 0xEC, 0xCC, 0xDD, 0xDC, 0x99, 0x9F, 0xBB, 0xB9, 0x33, 0x3E,
+    ]))
+
     def getValidExtensions(self):
         return ["gb", "gbc", "cgb", "sgb"]
 
-    def parse(self, filename):
+    def canVerify(self):
+        return True
+
+    def getSignatures(self):
+        return [(0x104, self.NINTENDO_LOGO)]
+
+    def parse(self, filename, verify=False):
         props = {}
-        with open(filename, "rb") as f:
-            data = bytearray(f.read(0x150))
+        with self._open(filename) as f:
+            # Verifying the global checksum streams the whole image
+            data = RomView(f) if verify else bytearray(f.read(0x150))
             if self.isValidData(data):
-                props = self.parseBuffer(data)
+                props = self.parseBuffer(data, verify)
         return props
 
     def isValidData(self, data):
@@ -46,14 +60,15 @@ class GameboyParser(RomInfoParser):
         Color Gameboy verifies only the first 24 bytes of the bitmap, but others
         (for example a pocket gameboy) verify all 48 bytes.
         """
-        nintendo_logo = [
-            0xCE, 0xED, 0x66, 0x66, 0xCC, 0x0D, 0x00, 0x0B, 0x03, 0x73, 0x00, 0x83, 0x00, 0x0C, 0x00, 0x0D,
-            0x00, 0x08, 0x11, 0x1F, 0x88, 0x89, 0x00, 0x0E, 0xDC, 0xCC, 0x6E, 0xE6, 0xDD, 0xDD, 0xD9, 0x99,
-            0xBB, 0xBB, 0x67, 0x63, 0x6E, 0x0E, 0xEC, 0xCC, 0xDD, 0xDC, 0x99, 0x9F, 0xBB, 0xB9, 0x33, 0x3E,
-        ]
-        return [b for b in data[0x104 : 0x104 + len(nintendo_logo)]] == nintendo_logo
+        return data[0x104 : 0x104 + len(self.NINTENDO_LOGO)] == self.NINTENDO_LOGO
 
-    def parseBuffer(self, data):
+    def parseBuffer(self, data, verify=False):
+        """
+        If verify is True, the header and global checksums are calculated and
+        compared to the stored ones ("header_checksum_valid" and
+        "global_checksum_valid"). The global checksum needs the whole image.
+        """
+        data = self._getView(data)
         props = {}
 
         # 0134-0143 - Title, UPPER CASE ASCII
@@ -109,8 +124,28 @@ class GameboyParser(RomInfoParser):
         # 014E-014F - Global checksum, 16 bit checksum across the whole cartridge ROM
         props["global_checksum"] = "%04X" % ((data[0x14e] << 8) | data[0x14f])
 
+        if verify:
+            props["header_checksum_valid"] = self.calculateHeaderChecksum(data) == data[0x14d]
+            props["global_checksum_valid"] = self.calculateGlobalChecksum(data) == (data[0x14e] << 8) | data[0x14f]
+
         return props
 
+    def calculateHeaderChecksum(self, data):
+        """
+        x = 0; for each byte in 0134-014C: x = x - byte - 1. The boot ROM locks
+        up if the lower 8 bits of the result don't match the header checksum.
+        """
+        return (-sum(data[0x134 : 0x14d]) - (0x14d - 0x134)) & 0xff
+
+    def calculateGlobalChecksum(self, data):
+        """
+        Sum of all bytes of the cartridge ROM, except the two checksum bytes.
+        Not verified by the Gameboy.
+        """
+        if not isinstance(data, RomView):
+            data = RomView(data)
+        return (self._sumBytes(data) - data[0x14e] - data[0x14f]) & 0xffff
+
 RomInfoParser.registerParser(GameboyParser())
 
 
@@ -1,7 +1,7 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+from rominfo import RomInfoParser, RomView
 
 # Publishers are the same across these handhelds
 from gameboy import gameboy_publishers
@@ -16,15 +16,37 @@ class GBAParser(RomInfoParser):
     * http://sourceforge.net/p/vbam/code/HEAD/tree/trunk/src/win32/RomInfo.cpp
     """
 
+    # Nintendo logo at 0004-009F, see isValidData()
+    NINTENDO_LOGO = bytes(bytearray([
+        # GBA is ARM microprocessor, so first 4 bytes is 32-bit ARM opcode saying "jump elsewhere"
+                                0x24, 0xFF, 0xAE, 0x51, 0x69, 0x9A, 0xA2, 0x21, 0x3D, 0x84, 0x82, 0x0A,
+        0x84, 0xE4, 0x09, 0xAD, 0x11, 0x24, 0x8B, 0x98, 0xC0, 0x81, 0x7F, 0x21, 0xA3, 0x52, 0xBE, 0x19,
+        0x93, 0x09, 0xCE, 0x20, 0x10, 0x46, 0x4A, 0x4A, 0xF8, 0x27, 0x31, 0xEC, 0x58, 0xC7, 0xE8, 0x33,
+        0x82, 0xE3, 0xCE, 0xBF, 0x85, 0xF4, 0xDF, 0x94, 0xCE, 0x4B, 0x09, 0xC1, 0x94, 0x56, 0x8A, 0xC0,
+        0x13, 0x72, 0xA7, 0xFC, 0x9F, 0x84, 0x4D, 0x73, 0xA3, 0xCA, 0x9A, 0x61, 0x58, 0x97, 0xA3, 0x27,
+        0xFC, 0x03, 0x98, 0x76, 0x23, 0x1D, 0xC7, 0x61, 0x03, 0x04, 0xAE, 0x56, 0xBF, 0x38, 0x84, 0x00,
+        0x40, 0xA7, 0x0E, 0xFD, 0xFF, 0x52, 0xFE, 0x03, 0x6F, 0x95, 0x30, 0xF1, 0x97, 0xFB, 0xC0, 0x85,
+        0x60, 0xD6, 0x80, 0x25, 0xA9, 0x63, 0xBE, 0x03, 0x01, 0x4E, 0x38, 0xE2, 0xF9, 0xA2, 0x34, 0xFF,
+        0xBB, 0x3E, 0x03, 0x44, 0x78, 0x00, 0x90, 0xCB, 0x88, 0x11, 0x3A, 0x94, 0x65, 0xC0, 0x7C, 0x63,
+        0x87, 0xF0, 0x3C, 0xAF, 0xD6, 0x25, 0xE4, 0x8B, 0x38, 0x0A, 0xAC, 0x72, 0x21, 0xD4, 0xF8, 0x07,
+    ]))
+
     def getValidExtensions(self):
         return ["gba", "agb"]
 
-    def parse(self, filename):
+    def canVerify(self):
+        return True
+
+    def getSignatures(self):
+        return [(0x04, self.NINTENDO_LOGO)]
+
+    def parse(self, filename, verify=False):
         props = {}
-        with open(filename, "rb") as f:
-            data = bytearray(f.read(0xc0))
+        with self._open(filename) as f:
+            # Finding the padding reads the end of the image
+            data = RomView(f) if verify else bytearray(f.read(0xc0))
             if self.isValidData(data):
-                props = self.parseBuffer(data)
+                props = self.parseBuffer(data, verify)
         return props
 
     def isValidData(self, data):
@@ -33,22 +55,16 @@ class GBAParser(RomInfoParser):
         displayed when the Gameboy gets turned on is stored in the 156 bytes from
         address $0004 to $009F. See the comment in gameboy.py for more info.
         """
-        nintendo_logo = [
-            # GBA is ARM microprocessor, so first 4 bytes is 32-bit ARM opcode saying "jump elsewhere"
-                                    0x24, 0xFF, 0xAE, 0x51, 0x69, 0x9A, 0xA2, 0x21, 0x3D, 0x84, 0x82, 0x0A,
-            0x84, 0xE4, 0x09, 0xAD, 0x11, 0x24, 0x8B, 0x98, 0xC0, 0x81, 0x7F, 0x21, 0xA3, 0x52, 0xBE, 0x19,
-            0x93, 0x09, 0xCE, 0x20, 0x10, 0x46, 0x4A, 0x4A, 0xF8, 0x27, 0x31, 0xEC, 0x58, 0xC7, 0xE8, 0x33,
-            0x82, 0xE3, 0xCE, 0xBF, 0x85, 0xF4, 0xDF, 0x94, 0xCE, 0x4B, 0x09, 0xC1, 0x94, 0x56, 0x8A, 0xC0,
-            0x13, 0x72, 0xA7, 0xFC, 0x9F, 0x84, 0x4D, 0x73, 0xA3, 0xCA, 0x9A, 0x61, 0x58, 0x97, 0xA3, 0x27,
-            0xFC, 0x03, 0x98, 0x76, 0x23, 0x1D, 0xC7, 0x61, 0x03, 0x04, 0xAE, 0x56, 0xBF, 0x38, 0x84, 0x00,
-            0x40, 0xA7, 0x0E, 0xFD, 0xFF, 0x52, 0xFE, 0x03, 0x6F, 0x95, 0x30, 0xF1, 0x97, 0xFB, 0xC0, 0x85,
-            0x60, 0xD6, 0x80, 0x25, 0xA9, 0x63, 0xBE, 0x03, 0x01, 0x4E, 0x38, 0xE2, 0xF9, 0xA2, 0x34, 0xFF,
-            0xBB, 0x3E, 0x03, 0x44, 0x78, 0x00, 0x90, 0xCB, 0x88, 0x11, 0x3A, 0x94, 0x65, 0xC0, 0x7C, 0x63,
-            0x87, 0xF0, 0x3C, 0xAF, 0xD6, 0x25, 0xE4, 0x8B, 0x38, 0x0A, 0xAC, 0x72, 0x21, 0xD4, 0xF8, 0x07,
-        ]
-        return [b for b in data[0x04 : 0x04 + len(nintendo_logo)]] == nintendo_logo
-
-    def parseBuffer(self, data):
+        return data[0x04 : 0x04 + len(self.NINTENDO_LOGO)] == self.NINTENDO_LOGO
+
+    def parseBuffer(self, data, verify=False):
+        """
+        If verify is True, the header checksum is calculated and compared to
+        the stored one ("header_checksum_valid"), and trailing 0xFF or 0x00
+        padding of the image is measured ("trimmed_size" and "padding_bytes").
+        The latter needs the whole image.
+        """
+        data = self._getView(data)
         props = {}
 
         # 00A0-00AB - Title, UPPER CASE ASCII, padded with 00h (if less than 12 chars)
@@ -75,8 +91,45 @@ class GBAParser(RomInfoParser):
         # 00BD - Header checksum, 8 bit checksum across the cartridge header bytes 00A0-00BC
         props["header_checksum"] = "%02X" % data[0xbd]
 
+        if verify:
+            props["header_checksum_valid"] = self.calculateHeaderChecksum(data) == data[0xbd]
+            trimmedSize = self.getTrimmedSize(data)
+            props["trimmed_size"] = trimmedSize
+            props["padding_bytes"] = len(data) - trimmedSize
+
         props["platform"] = "Game Boy Advance"
 
         return props
 
+    def calculateHeaderChecksum(self, data):
+        """
+        Complement check of 00A0-00BC: chk = 0; for each byte: chk = chk - byte;
+        chk = chk - 0x19. The GBA won't boot if the lower 8 bits don't match.
+        """
+        return (-sum(data[0xa0 : 0xbd]) - 0x19) & 0xff
+
+    def getTrimmedSize(self, data):
+        """
+        Return the size of the image without trailing padding, which is a run
+        of the image's last byte if that is 0xFF or 0x00. The image is scanned
+        backwards a block at a time.
+        """
+        if not isinstance(data, RomView):
+            data = RomView(data)
+        end = len(data)
+        if not end or data[end - 1] not in [0xff, 0x00]:
+            return end
+        pad = bytes(bytearray([data[end - 1]]))
+        buf = bytearray(self.CHUNK_SIZE)
+        while end > 0:
+            start = max(end - self.CHUNK_SIZE, 0)
+            size = data.readinto(start, buf, end - start)
+            # bytearray.rstrip() scans the block in C
+            block = buf if size == len(buf) else buf[ : size]
+            trimmed = len(block.rstrip(pad))
+            if trimmed:
+                return start + trimmed
+            end = start
+        return 0
+
 RomInfoParser.registerParser(GBAParser())
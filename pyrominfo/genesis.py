@@ -1,7 +1,7 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+from rominfo import RomInfoParser, RomView
 
 class GensisParser(RomInfoParser):
     """
@@ -22,14 +22,28 @@ class GensisParser(RomInfoParser):
     def getValidExtensions(self):
         return ["smd", "gen", "32x", "md", "bin", "iso", "mdx"]
 
-    def parse(self, filename):
+    def canVerify(self):
+        return True
+
+    def parse(self, filename, verify=False):
         props = {}
-        with open(filename, "rb") as f:
-            data = bytearray(f.read())
+        with self._open(filename) as f:
+            # Only the blocks holding the header are read from disk, unless
+            # the checksum is verified
+            data = RomView(f)
             if len(data):
-                props = self.parseBuffer(data)
+                props = self.parseBuffer(data, verify)
         return props
 
+    def getCanonicalImage(self, data):
+        # Hash the deinterleaved image, without the SMD header. SMD blocks can
+        # be deinterleaved chunk by chunk, as chunks are a multiple of 16 KB.
+        if self.hasSMDHeader(data):
+            return (data.window(0x200), self.deinterleaveSMD)
+        if self.isInterleaved(data):
+            return (DeinterleavedView(data, len(data)), None)
+        return (data, None)
+
     def isValidData(self, data):
         """
         Detect console name (one of two values, depending on the console's country
@@ -42,18 +56,24 @@ class GensisParser(RomInfoParser):
             return True
         return False
 
-    def parseBuffer(self, data):
+    def parseBuffer(self, data, verify=False):
+        """
+        If verify is True, the checksum of the image is calculated
+        ("calculated_checksum") and compared to the header's ("checksum_valid").
+        """
         props = {}
 
         # TODO: If extension is .mdx, decode image
         #data = [b ^ 0x40 for b in data[4 : -1]] # len(data) decreases by 5
 
-        # Auto-detect SMD/MD interleaving
+        # Auto-detect SMD/MD interleaving. Instead of deinterleaving the whole
+        # image, header reads are translated to the bytes they come from.
+        if not isinstance(data, RomView):
+            data = RomView(data)
         if self.hasSMDHeader(data):
-            data = data[0x200 : ]
-            self.deinterleaveSMD(data)
+            data = DeinterleavedView(data.window(0x200), 0x4000)
         elif self.isInterleaved(data):
-            self.deinterleaveMD(data)
+            data = DeinterleavedView(data, len(data))
 
         # 0100-010f - Console name, can be "SEGA MEGA DRIVE" or "SEGA GENESIS"
         #             depending on the console's country of origin.
@@ -98,8 +118,20 @@ class GensisParser(RomInfoParser):
         #             single hex digit which represents a new-style country code.
         props["country_codes"] = self._sanitize(data[0x1f0 : 0x1f0 + 16])
 
+        if verify:
+            checksum = self.calculateChecksum(data)
+            props["calculated_checksum"] = "%04X" % checksum
+            props["checksum_valid"] = checksum == data[0x18e] << 8 | data[0x18f]
+
         return props
 
+    def calculateChecksum(self, data):
+        """
+        The checksum is the 16-bit sum of the big-endian words of the
+        (deinterleaved) image after the header, from 0200 to the end.
+        """
+        return self._sumWords(data, 0x200) & 0xffff
+
     def deinterleaveSMD(self, data):
         """
         Super Magic Drive interleaved file-format (.SMD) is a non-straight-forward
@@ -126,7 +158,7 @@ class GensisParser(RomInfoParser):
         """
         if len(data) < 512:
             return False
-        if data[0x08:0x0a] == b"\xAA\xBB\x06":
+        if data[0x08:0x0b] == b"\xAA\xBB\x06":
             return True
 
         # If the SMD header's binary data is corrupt or uniform zero, we still
@@ -137,7 +169,9 @@ class GensisParser(RomInfoParser):
             return True
 
         # Finally, directly analyze the payload
-        return self.isInterleaved(data[0x200 : ])
+        if not isinstance(data, RomView):
+            data = RomView(data)
+        return self.isInterleaved(data.window(0x200))
 
     def deinterleaveMD(self, data):
         """
@@ -159,11 +193,11 @@ class GensisParser(RomInfoParser):
         # Gens checks data[0x80 : 0x81] == b"EA" (odd bytes) for evidence of
         # interlacing. I think MAME also checks data[0x2080 : 0x2081] == b"SG"
         # (even bytes).
-        if data[0x80 : 0x81] == b"EA" and data[0x2080 : 0x2081] == b"SG":
+        if data[0x80 : 0x82] == b"EA" and data[0x2080 : 0x2082] == b"SG":
             return True
 
         # Phelios USA redump, Target Earth, Klax (Namcot)
-        if data[0x80 : 0x81] == b"SG" and data[0x2080 : 0x2081] == b" E":
+        if data[0x80 : 0x82] == b"SG" and data[0x2080 : 0x2082] == b" E":
             return True
 
         # For MD interleaving, instead of looking for odd bytes, just look for
@@ -207,6 +241,59 @@ class GensisParser(RomInfoParser):
 RomInfoParser.registerParser(GensisParser())
 
 
+class DeinterleavedView(RomView):
+    """
+    View of an SMD or MD interleaved image in deinterleaved order. The image
+    is made of blocks of blockSize bytes (16 KB for SMD, the whole image for
+    MD) that store the odd bytes in their first half and the even bytes in
+    their second half; see deinterleaveSMD() and deinterleaveMD(). Reads are
+    translated to the one or two physical ranges they come from, so reading
+    the header never touches more than the first block.
+    """
+
+    def __init__(self, view, blockSize):
+        RomView.__init__(self, view.source, view.offset, view.size)
+        self.pages = view.pages
+        self.view = view
+        self.blockSize = max(blockSize, 1)
+        # Like deinterleaveSMD(), a trailing partial block is left as-is
+        self.blocks = view.size // self.blockSize
+
+    def read(self, start, length):
+        end = min(start + length, self.size)
+        # Header reads go through the page cache. Reads of whole pages
+        # (verifying the checksum walks every block) are read straight into
+        # new buffers, so that the cache doesn't end up holding the image.
+        cached = length < self.PAGE_SIZE or not self.isFile
+        parts = []
+        while start < end:
+            block = start // self.blockSize
+            base = block * self.blockSize
+            if block >= self.blocks:
+                parts.append(self._readHalf(start, end - start, cached))
+                break
+            stop = min(end, base + self.blockSize)
+            # Logical byte base + i comes from base + half + i / 2 if i is even,
+            # or from base + i / 2 if i is odd
+            lo = (start - base) >> 1
+            hi = (stop - base + 1) >> 1
+            even = self._readHalf(base + (self.blockSize >> 1) + lo, hi - lo, cached)
+            odd = self._readHalf(base + lo, hi - lo, cached)
+            data = bytearray(2 * (hi - lo))
+            data[0 : 2 * len(even) : 2] = even
+            data[1 : 2 * len(odd) : 2] = odd
+            parts.append(data[start - base - 2 * lo : stop - base - 2 * lo])
+            start = stop
+        return bytearray().join(parts)
+
+    def _readHalf(self, start, length, cached):
+        if cached:
+            return self.view.read(start, length)
+        data = bytearray(length)
+        del data[self.view.readinto(start, data) : ]
+        return data
+
+
 genesis_devices = {
     "J": "3B Joypad",
     "6": "6B Joypad",
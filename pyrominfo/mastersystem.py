@@ -1,7 +1,7 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+from rominfo import RomInfoParser, RomView
 
 class MasterSystemParser(RomInfoParser):
     """
@@ -12,13 +12,22 @@ class MasterSystemParser(RomInfoParser):
     * http://www.smspower.org/Development/SDSCHeader
     """
 
+    # SDSC strings are read up to this many bytes. Override on the instance to
+    # allow longer descriptions.
+    MAX_STRING_LENGTH = 0x1000
+
     def getValidExtensions(self):
         return ["sms", "gg", "sg"]
 
+    def getSignatures(self):
+        return [(offset, b"TMR SEGA") for offset in [0x1ff0, 0x3ff0, 0x7ff0, 0x81f0]] + [(0x7fe0, b"SDSC")]
+
     def parse(self, filename):
         props = {}
-        with open(filename, "rb") as f:
-            data = bytearray(f.read())
+        with self._open(filename) as f:
+            # Only the header candidates, the SDSC block and the strings it
+            # points to are read from disk
+            data = RomView(f)
             # First header check is at 0x1FF0, so we clearly need at least this much data
             if len(data) >= 0x2000:
                 props = self.parseBuffer(data)
@@ -43,6 +52,7 @@ class MasterSystemParser(RomInfoParser):
         return False
 
     def parseBuffer(self, data):
+        data = self._getView(data)
         props = {}
 
         # Find Master System header offset (see isValidData(), default to 0x7FF0)
@@ -132,14 +142,14 @@ class MasterSystemParser(RomInfoParser):
 
     def get_cstr(self, ptr, data):
         """
-        Parse a zero-terminated (c-style) string from a bytearray. 0xFFFF and
-        0x0000 are invalid ptr values and will return "".
+        Parse a zero-terminated (c-style) string from a bytearray or RomView,
+        reading at most MAX_STRING_LENGTH bytes. 0xFFFF and 0x0000 are invalid
+        ptr values and will return "".
         """
         if ptr != 0xffff and ptr != 0 and ptr < len(data):
-            term = ptr
-            while term < len(data) and data[term]:
-                term += 1
-            return self._sanitize(data[ptr : term])
+            s = data[ptr : ptr + self.MAX_STRING_LENGTH]
+            term = s.find(b"\x00")
+            return self._sanitize(s[ : term] if term >= 0 else s)
         return ""
         
 
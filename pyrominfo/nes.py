@@ -1,7 +1,7 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+from rominfo import RomInfoParser, RomView
 
 class NESParser(RomInfoParser):
     """
@@ -17,18 +17,24 @@ class NESParser(RomInfoParser):
     def getValidExtensions(self):
         return ["nes", "nez", "unf", "unif"]
 
+    def getSignatures(self):
+        return [(0, b"NES\x1a"), (0, b"UNIF")]
+
     def parse(self, filename):
         props = {}
-        with open(filename, "rb") as f:
-            ext = self._getExtension(filename)
-            if ext in ["unf", "unif"]:
-                data = bytearray(f.read())
-            else:
-                data = bytearray(f.read(16))
+        with self._open(filename) as f:
+            # The magic tells UNIF from iNES, whatever the file is named. Only
+            # the pages holding the iNES header or the UNIF chunk headers are
+            # read, see iterUNIFChunks().
+            data = RomView(f)
             if self.isValidData(data):
                 props = self.parseBuffer(data)
         return props
 
+    def getCanonicalImage(self, data):
+        # Hash iNES images without their 16-byte header
+        return (data.window(16) if data[:4] == b"NES\x1a" else data, None)
+
     def isValidData(self, data):
         """
         Test for a valid NES image by checking the first 4 bytes for a UNIF or
@@ -38,6 +44,7 @@ class NESParser(RomInfoParser):
         return data[:4] == b"NES\x1a" or data[:4] == b"UNIF"
 
     def parseBuffer(self, data):
+        data = self._getView(data)
         props = {}
 
         if data[:4] == b"NES\x1a":
@@ -72,19 +79,13 @@ class NESParser(RomInfoParser):
             props["video_output"] = ""
             props["title"] = ""
 
-            # Skip the UNIF header (0x20 / 32 bytes) and continue with chunked reads
-            data = data[0x20 : ]
-            while len(data) > 8:
-                size = 0
-                sizestr = data[4:8]
-                if len(sizestr) == 4:
-                    size = sizestr[0] | (sizestr[1] << 8) | (sizestr[2] << 16) | (sizestr[3] << 24)
-                if size == 0:
+            # Every chunk header is walked, so that like a full scan of the
+            # image, a repeated chunk overrides the ones before it
+            wanted = set(["NAME", "TVCI", "BATR", "MIRR"])
+            for (ID, offset, size) in self.iterUNIFChunks(data):
+                if ID not in wanted:
                     continue
-
-                ID = self._sanitize(data[ : 4])
-                chunk = data[8 : 8 + size]
-                data = data[8 + size : ] # Fast-forward past chunk's data
+                chunk = data[offset : offset + size]
 
                 if ID == "NAME":
                     props["title"] = self._sanitize(chunk)
@@ -98,4 +99,21 @@ class NESParser(RomInfoParser):
 
         return props
 
+    def iterUNIFChunks(self, data):
+        """
+        Walk the chunks following the UNIF header (0x20 / 32 bytes), yielding
+        (ID, offset, size) for each chunk's data. Only the 8-byte chunk headers
+        are read, so with a RomView the chunk data (e.g. PRG and CHR ROM) is
+        never read unless the caller asks for it. Chunks without data are
+        skipped.
+        """
+        offset = 0x20
+        while offset + 8 < len(data):
+            chunk = data[offset : offset + 8]
+            size = chunk[4] | (chunk[5] << 8) | (chunk[6] << 16) | (chunk[7] << 24)
+            offset += 8
+            if size:
+                yield (self._sanitize(chunk[ : 4]), offset, size)
+                offset += size # Fast-forward past chunk's data
+
 RomInfoParser.registerParser(NESParser())
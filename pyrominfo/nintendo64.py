@@ -1,7 +1,17 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
-from rominfo import RomInfoParser
+import sys
+import mmap
+import zlib
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rominfo import RomInfoParser, RomView
 
 class Nintendo64Parser(RomInfoParser):
     """
@@ -10,42 +20,84 @@ class Nintendo64Parser(RomInfoParser):
     related source code:
     * rom.c of the Mupen64Plus project:
     * https://bitbucket.org/richard42/mupen64plus-core/src/4cd70c2b5d38/src/main/rom.c
+    * n64crc.c by Parasyte (CRC1/CRC2 calculation):
+    * http://n64dev.org/n64crc.html
     """
 
+    # Magic word 0x80371240 in each byte order
+    MAGIC_Z64 = b"\x80\x37\x12\x40" # [ABCD]
+    MAGIC_V64 = b"\x37\x80\x40\x12" # [BADC]
+    MAGIC_N64 = b"\x40\x12\x37\x80" # [DCBA]
+    MAGIC_WORDSWAPPED = b"\x12\x40\x80\x37" # [CDAB]
+
+    # The CRCs cover the 1 MB following the boot code
+    CHECKSUM_START = 0x1000
+    CHECKSUM_LENGTH = 0x100000
+
     def getValidExtensions(self):
         return ["n64", "v64", "z64"]
 
-    def parse(self, filename):
+    def canVerify(self):
+        return True
+
+    def getSignatures(self):
+        return [(0, magic) for magic in [Nintendo64Parser.MAGIC_Z64, Nintendo64Parser.MAGIC_V64,
+                                         Nintendo64Parser.MAGIC_N64, Nintendo64Parser.MAGIC_WORDSWAPPED]]
+
+    def parse(self, filename, verify=False):
         props = {}
-        with open(filename, "rb") as f:
-            data = bytearray(f.read(64))
+        with self._open(filename) as f:
+            # Verifying the CRCs needs the boot code and the checksummed 1 MB
+            length = self.CHECKSUM_START + self.CHECKSUM_LENGTH if verify else 64
+            data = bytearray(f.read(length))
             if self.isValidData(data):
-                props = self.parseBuffer(data)
+                props = self.parseBuffer(data, verify)
         return props
 
+    def getCanonicalImage(self, data):
+        # Hash the image in native (.z64) byte order. Chunks are a multiple of
+        # 4 bytes, so they can be converted separately.
+        magic = data[:4]
+        if magic in [Nintendo64Parser.MAGIC_V64, Nintendo64Parser.MAGIC_N64, Nintendo64Parser.MAGIC_WORDSWAPPED]:
+            return (data, lambda chunk: self.makeNativeFormat(chunk, magic))
+        return (data, None)
+
     def isValidData(self, data):
         """
         Test for a valid N64 image by checking the first 4 bytes for the magic word.
         """
         if len(data) >= 64:
+            magic = data[:4]
             # Test if rom is a native (big endian) .z64 image with header 0x80371240. [ABCD]
-            if [b for b in data[:4]] == [0x80, 0x37, 0x12, 0x40]:
+            if magic == Nintendo64Parser.MAGIC_Z64:
                 return True
             # Test if rom is a byteswapped .v64 image with header 0x37804012. [BADC]
-            if [b for b in data[:4]] == [0x37, 0x80, 0x40, 0x12]:
+            if magic == Nintendo64Parser.MAGIC_V64:
                 return True
             # Test if rom is a little endian .n64 image with header 0x40123780. [DCBA]
-            if [b for b in data[:4]] == [0x40, 0x12, 0x37, 0x80]:
+            if magic == Nintendo64Parser.MAGIC_N64:
                 return True
             # Test if rom is a wordswapped .n64 image with header 0x40123780. [CDAB]
-            if [b for b in data[:4]] == [0x12, 0x40, 0x80, 0x37]:
+            if magic == Nintendo64Parser.MAGIC_WORDSWAPPED:
                 return True
         return False
 
-    def parseBuffer(self, data):
+    def parseBuffer(self, data, verify=False):
+        """
+        If verify is True, the CIC boot chip is identified from the boot code
+        ("cic") and CRC1 and CRC2 are calculated and compared to the header's
+        ("crc_valid"). This needs the first 0x101000 bytes of the image.
+        """
+        data = self._getView(data)
         props = {}
 
-        self.makeNativeFormat(data)
+        # Images that aren't in native byte order are converted in a copy of
+        # the part that is needed
+        if data[:4] != Nintendo64Parser.MAGIC_Z64:
+            data = data[ : self.CHECKSUM_START + self.CHECKSUM_LENGTH if verify else 64]
+            if not isinstance(data, bytearray):
+                data = bytearray(data)
+            self.makeNativeFormat(data)
 
         props["title"] = self._sanitize(data[0x20 : 0x20 + 20])
 
@@ -64,18 +116,185 @@ class Nintendo64Parser(RomInfoParser):
         props["region"] = n64_regions.get(data[0x3e], "")
         props["region_code"] = "%02X" % data[0x3e]
 
+        if verify:
+            cic = self.getCIC(data)
+            props["cic"] = ("CIC-NUS-%d" % cic) if cic else ""
+            crcs = self.calculateCRCs(data, cic)
+            props["crc_valid"] = crcs is not None and \
+                                 "%08X" % crcs[0] == props["crc1"] and "%08X" % crcs[1] == props["crc2"]
+
         return props
 
-    def makeNativeFormat(self, data):
+    def getCIC(self, data):
         """
-        Correct for word- and byte-swapping.
+        Identify the CIC boot chip by the CRC32 of the IPL3 boot code at
+        0040-0FFF of a native byte order image. Returns None if unknown.
         """
-        if [b for b in data[:4]] == [0x37, 0x80, 0x40, 0x12]: # [BADC]
-            data[::2], data[1::2] = data[1::2], data[::2]
-        elif [b for b in data[:4]] == [0x40, 0x12, 0x37, 0x80]: # [DCBA]
-            data[::4], data[1::4], data[2::4], data[3::4] = data[3::4], data[2::4], data[1::4], data[::4]
-        elif [b for b in data[:4]] == [0x12, 0x40, 0x80, 0x37]: # [CDAB]
-            data[::4], data[1::4], data[2::4], data[3::4] = data[2::4], data[3::4], data[::4], data[1::4]
+        return n64_cic_boot_codes.get(zlib.crc32(bytes(data[0x40 : 0x1000])) & 0xffffffff)
+
+    def calculateCRCs(self, data, cic):
+        """
+        Calculate CRC1 and CRC2 of a native byte order image booted by the
+        given CIC chip, or return None if the chip is unknown. Images shorter
+        than the checksummed range are zero-padded.
+        """
+        seed = n64_cic_seeds.get(cic)
+        if seed is None:
+            return None
+        chunk = bytes(data[self.CHECKSUM_START : self.CHECKSUM_START + self.CHECKSUM_LENGTH])
+        chunk += b"\x00" * (self.CHECKSUM_LENGTH - len(chunk))
+        # The CIC 6105 mixes in the words of 0750-084F of its boot code
+        key = bytes(data[0x750 : 0x850]).ljust(0x100, b"\x00") if cic == 6105 else None
+        if numpy is not None:
+            (t1, t2, t3, t4, t5, t6) = self._sumCRCWordsNumpy(chunk, seed, key)
+        else:
+            (t1, t2, t3, t4, t5, t6) = self._sumCRCWords(chunk, seed, key)
+        if cic == 6103:
+            crcs = ((t6 ^ t4) + t3, (t5 ^ t2) + t1)
+        elif cic == 6106:
+            crcs = ((t6 * t4) + t3, (t5 * t2) + t1)
+        else:
+            crcs = (t6 ^ t4 ^ t3, t5 ^ t2 ^ t1)
+        return (crcs[0] & 0xffffffff, crcs[1] & 0xffffffff)
+
+    def _sumCRCWords(self, chunk, seed, key):
+        """
+        Run the CRC loop over the big-endian 32-bit words of chunk, returning
+        the accumulators t1 to t6.
+        """
+        M = 0xffffffff
+        words = self._getWords(chunk)
+        keys = self._getWords(key) if key else None
+        t1 = t2 = t3 = t4 = t5 = t6 = seed
+        for i, d in enumerate(words):
+            t6 += d
+            if t6 > M:
+                t6 &= M
+                t4 += 1
+            t3 ^= d
+            s = d & 0x1f
+            r = ((d << s) | (d >> (32 - s))) & M
+            t5 = (t5 + r) & M
+            if t2 > d:
+                t2 ^= r
+            else:
+                t2 ^= t6 ^ d
+            t1 = (t1 + ((keys[i & 0x3f] if keys else t5) ^ d)) & M
+        return (t1, t2, t3, t4 & M, t5, t6)
+
+    def _sumCRCWordsNumpy(self, chunk, seed, key):
+        """
+        Same as _sumCRCWords(), with all accumulators but t2 reduced by numpy.
+        The carries of t6 are counted by t4, which is the number of times the
+        running sum wraps. Only t2 depends on its own previous value, so it
+        is updated in a loop over precomputed operands.
+        """
+        M = 0xffffffff
+        d = numpy.frombuffer(chunk, ">u4").astype(numpy.uint64)
+        total = seed + int(d.sum())
+        t6s = (seed + numpy.cumsum(d)) & M
+        t6 = total & M
+        t4 = (seed + (total >> 32)) & M
+        t3 = seed ^ int(numpy.bitwise_xor.reduce(d))
+        s = d & 0x1f
+        r = ((d << s) | (d >> (32 - s))) & M
+        t5s = (seed + numpy.cumsum(r)) & M
+        t5 = int(t5s[-1])
+        if key:
+            keys = numpy.frombuffer(key, ">u4").astype(numpy.uint64)
+            t1 = (seed + int((numpy.tile(keys, len(d) // len(keys)) ^ d).sum())) & M
+        else:
+            t1 = (seed + int((t5s ^ d).sum())) & M
+        t2 = seed
+        for (dw, rw, xw) in zip(d.tolist(), r.tolist(), (t6s ^ d).tolist()):
+            t2 ^= rw if t2 > dw else xw
+        return (t1, t2, t3, t4, t5, t6)
+
+    def _getWords(self, data):
+        """
+        Unpack big-endian 32-bit words.
+        """
+        words = array.array(self._getArrayCode(4), data)
+        if sys.byteorder == "little":
+            words.byteswap()
+        return words
+
+    def _getArrayCode(self, size):
+        """
+        Return the array type code of unsigned integers of size bytes.
+        """
+        return [code for code in "BHIL" if array.array(code).itemsize == size][0]
+
+    def convertFile(self, filename, outfile=None):
+        """
+        Rewrite an image in native (.z64) byte order. The image is converted a
+        chunk at a time into outfile, or in place through a memory map if
+        outfile is None, so it is never loaded into memory as a whole.
+        Returns False if filename isn't an N64 image.
+        """
+        with open(filename, "rb" if outfile else "r+b") as f:
+            magic = f.read(4)
+            if magic not in [Nintendo64Parser.MAGIC_Z64, Nintendo64Parser.MAGIC_V64,
+                             Nintendo64Parser.MAGIC_N64, Nintendo64Parser.MAGIC_WORDSWAPPED]:
+                return False
+            if outfile is None:
+                if magic != Nintendo64Parser.MAGIC_Z64:
+                    data = mmap.mmap(f.fileno(), 0)
+                    try:
+                        self.makeNativeFormat(data, magic)
+                        data.flush()
+                    finally:
+                        data.close()
+                return True
+            with open(outfile, "wb") as out:
+                data = RomView(f)
+                buf = bytearray(self.CHUNK_SIZE)
+                pos = 0
+                while pos < len(data):
+                    size = data.readinto(pos, buf)
+                    if size <= 0:
+                        break
+                    chunk = buf if size == len(buf) else buf[ : size]
+                    self.makeNativeFormat(chunk, magic)
+                    out.write(chunk)
+                    pos += size
+        return True
+
+    def makeNativeFormat(self, data, magic=None):
+        """
+        Correct for word- and byte-swapping of data, a bytearray or a writable
+        mmap, in place. The byte order is detected from the magic word, which
+        can be given for data not starting with it.
+        """
+        if magic is None:
+            magic = data[:4]
+        if magic == Nintendo64Parser.MAGIC_V64: # [BADC]
+            self._byteswap(data, 2)
+        elif magic == Nintendo64Parser.MAGIC_N64: # [DCBA]
+            self._byteswap(data, 4)
+        elif magic == Nintendo64Parser.MAGIC_WORDSWAPPED: # [CDAB] -> [BADC] -> [ABCD]
+            self._byteswap(data, 4)
+            self._byteswap(data, 2)
+
+    def _byteswap(self, data, size):
+        """
+        Reverse the bytes of each size-byte word of data in place, leaving a
+        trailing partial word as-is. numpy swaps data through a view, without
+        copying it. Otherwise, words are swapped a chunk at a time through an
+        array.
+        """
+        length = len(data) - len(data) % size
+        if not length:
+            return
+        if numpy is not None:
+            numpy.frombuffer(data, "u%d" % size, length // size).byteswap(True)
+            return
+        code = self._getArrayCode(size)
+        for pos in range(0, length, self.CHUNK_SIZE):
+            end = min(pos + self.CHUNK_SIZE, length)
+            words = array.array(code, bytes(data[pos : end]))
+            words.byteswap()
+            data[pos : end] = words.tobytes() if hasattr(words, "tobytes") else words.tostring()
 
 RomInfoParser.registerParser(Nintendo64Parser())
 
@@ -101,6 +320,24 @@ n64_regions = {
     0x70: "Europe",
 }
 
+# CIC boot chips, by the CRC32 of the IPL3 boot code they accept
+n64_cic_boot_codes = {
+    0x6170A4A1: 6101,
+    0x90BB6CB5: 6102,
+    0x0B050EE0: 6103,
+    0x98BC2C86: 6105,
+    0xACC8580A: 6106,
+}
+
+# Initial value of the CRC accumulators for each CIC chip
+n64_cic_seeds = {
+    6101: 0xF8CA4DDC,
+    6102: 0xF8CA4DDC,
+    6103: 0xA3886759,
+    6105: 0xDF26F436,
+    6106: 0x1FEA617A,
+}
+
 n64_publishers = {
     "N": "Nintendo",
 }
@@ -24,6 +24,104 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import sys
+import time
+import zlib
+import array
+import hashlib
+import threading
+import contextlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    buffer
+    def _getBuffer(data, size):
+        return buffer(data, 0, size)
+except NameError:
+    def _getBuffer(data, size):
+        return memoryview(data)[ : size]
+
+def _getClock():
+    """
+    Return the clock of instrumentation events, in seconds. Python 3 has
+    time.perf_counter(). Python 2 has no monotonic clock, so POSIX
+    clock_gettime(CLOCK_MONOTONIC) is called through ctypes, or on Windows
+    time.clock() (QueryPerformanceCounter) is used. The wall clock is the
+    last resort.
+    """
+    if hasattr(time, "perf_counter"):
+        return time.perf_counter
+    if sys.platform == "win32":
+        return time.clock
+    # Values of CLOCK_MONOTONIC
+    clockIds = {"linux": 1, "darwin": 6, "freebsd": 4}
+    clockId = [clockIds[name] for name in clockIds if sys.platform.startswith(name)]
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        libc = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"))
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        if not clockId or clock_gettime(clockId[0], ctypes.byref(ts)) != 0:
+            return time.time
+    except (ImportError, OSError, AttributeError, TypeError):
+        return time.time
+
+    def monotonic():
+        # A timespec per call, as events come from several threads
+        ts = timespec()
+        clock_gettime(clockId[0], ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+_clock = _getClock()
+
+# Instrumentation hooks, see RomInfoParser.addHook(). Events are only built
+# when there are hooks, so by default an event costs a test of this list.
+# It is changed in place (other modules import it) under _hooksLock, and
+# events iterate over a snapshot of it, as scan threads may be emitting.
+_hooks = []
+_hooksLock = threading.Lock()
+
+def _emit(event, parser, **details):
+    details["time"] = _clock()
+    if details.get("duration", 0) < 0:
+        # Only the wall clock goes backwards
+        details["duration"] = 0.0
+    for hook in tuple(_hooks):
+        hook(event, parser, details)
+
+def _callParser(parser, func, arg, filename=None, verify=False):
+    """
+    Return func(arg), func being parser.parse or parser.parseBuffer, and
+    report the call to the instrumentation hooks as a "parse" event. verify
+    is passed on to parsers that support it (see canVerify()).
+    """
+    args = (arg, True) if verify and parser.canVerify() else (arg,)
+    if not _hooks:
+        return func(*args)
+    start = _clock()
+    props = None
+    error = None
+    try:
+        props = func(*args)
+        return props
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _emit("parse", parser, filename=filename, method=func.__name__, duration=_clock() - start,
+              found=bool(props and any(props)), error=error)
+
 class RomInfoParser(object):
     """
     Base class for ROM info parsers. When an info parser subclasses this
@@ -34,14 +132,130 @@ class RomInfoParser(object):
 
     __parsers = []
 
+    # Extension -> parsers claiming it, by priority, and the (priority,
+    # parser) entries they are sorted from
+    __extensions = {}
+    __priorities = {}
+
+    # Signature offset -> (magic, parser) entries, the (offset, window length,
+    # entries) to check, sorted by offset, and the parsers without signatures
+    __signatures = {}
+    __signatureWindows = []
+    __probedParsers = []
+
+    # Chunk size of hashBuffer(), _sumBytes() and _sumWords(), a multiple of
+    # the 16 KB SMD block size
+    CHUNK_SIZE = 0x100000
+
     @staticmethod
-    def registerParser(romInfoParser):
+    def registerParser(romInfoParser, priority=0):
+        """
+        Register a parser. Parsers that claim the same extension are tried in
+        order of priority (highest first), then in order of registration.
+        """
         RomInfoParser.__parsers.append(romInfoParser)
+        for ext in romInfoParser.getValidExtensions():
+            entries = RomInfoParser.__priorities.setdefault(ext, [])
+            entries.append((priority, romInfoParser))
+            entries.sort(key=lambda entry: -entry[0]) # Stable, keeps registration order
+            RomInfoParser.__extensions[ext] = tuple(entry[1] for entry in entries)
+        signatures = romInfoParser.getSignatures()
+        for (offset, magic) in signatures:
+            RomInfoParser.__signatures.setdefault(offset, []).append((magic, romInfoParser))
+        if signatures:
+            RomInfoParser.__signatureWindows = sorted(
+                ((offset, max(len(magic) for (magic, parser) in entries), entries)
+                 for (offset, entries) in RomInfoParser.__signatures.items()),
+                key=lambda window: window[0])
+        else:
+            RomInfoParser.__probedParsers.append(romInfoParser)
 
     @staticmethod
     def getParsers():
         return RomInfoParser.__parsers
 
+    @staticmethod
+    def addHook(hook):
+        """
+        Register an instrumentation hook, called as hook(event, parser,
+        details) from the thread doing the work. parser is the parser the
+        event concerns, or None for RomInfo's own work (picking parsers and
+        sniffing files). details is a dict with a "time" in seconds and, by
+        event, the fields below. Times come from a monotonic clock, except on
+        Python 2 where none can be found (see _getClock()). There they come
+        from the wall clock, and durations are clamped at 0.
+
+        dispatch  Parsers were looked up for a file: "filename", "by"
+                  ("extension" or "contents") and "parsers" (the candidates
+                  in order, None when found by contents; see "validate").
+        validate  A parser was checked against a file's contents: "by"
+                  ("signature" or "probe", i.e. isValidData(), which also
+                  gives "duration") and "valid".
+        open      A file was opened: "filename".
+        read      Bytes were read from a file: "filename" and "bytes".
+        parse     parse() or parseBuffer() returned or raised: "filename",
+                  "method", "duration", "found" (whether props were found)
+                  and "error" (the exception, or None).
+        result    RomInfo is done with a file: "filename", "found", "tried"
+                  (the number of parsers called) and "duration". parser is
+                  the one that succeeded, None for a miss.
+
+        See stats.ParserCounters for a hook aggregating these per parser.
+        """
+        with _hooksLock:
+            _hooks.append(hook)
+
+    @staticmethod
+    def removeHook(hook):
+        with _hooksLock:
+            _hooks.remove(hook)
+
+    @staticmethod
+    def getParsersForExtension(ext):
+        """
+        Return the registered parsers that claim ext (lower case, without the
+        dot), in the order they should be tried.
+        """
+        return RomInfoParser.__extensions.get(ext, ())
+
+    @staticmethod
+    def getParsersForData(data, probe=True):
+        """
+        Yield the registered parsers that recognize data (a bytearray or a
+        RomView). Parsers with a matching signature come first; every signature
+        offset is sliced only once, no matter how many parsers check it. Then,
+        if probe is True, the parsers without signatures are probed with
+        isValidData(). This is lazy, so stop iterating once a parser has
+        succeeded.
+
+        The probes are heuristics that accept most data of the right size, so
+        files of unknown type are only sniffed for signatures (probe=False).
+        """
+        matched = set()
+        for (offset, length, entries) in RomInfoParser.__signatureWindows:
+            window = data[offset : offset + length]
+            for (magic, parser) in entries:
+                if window.startswith(magic):
+                    matched.add(parser)
+        for parser in RomInfoParser.__parsers:
+            if parser in matched:
+                if _hooks:
+                    _emit("validate", parser, by="signature", valid=True)
+                yield parser
+        if not probe:
+            return
+        for parser in RomInfoParser.__probedParsers:
+            start = _clock() if _hooks else None
+            try:
+                valid = parser.isValidData(data)
+            except Exception:
+                # Heuristics reading past the end of short data are a miss
+                valid = False
+            if _hooks:
+                _emit("validate", parser, by="probe", valid=bool(valid), duration=_clock() - start)
+            if valid:
+                yield parser
+
     def __init__(self):
         pass
 
@@ -51,6 +265,24 @@ class RomInfoParser(object):
     def isValidExtension(self, ext):
         return ext in self.getValidExtensions()
 
+    def getSignatures(self):
+        """
+        Return (offset, magic) pairs, any of which identifies data this parser
+        can handle. Parsers with signatures are identified by them alone (see
+        getParsersForData()), so isValidData() should accept exactly the data
+        matching one of them. Parsers that need heuristics return none, and
+        are probed with isValidData() instead.
+        """
+        return []
+
+    def canVerify(self):
+        """
+        Return True if parse() and parseBuffer() take a verify argument, which
+        checks the image's checksums (reading more of it). RomInfo.parse()
+        only passes verify=True to these parsers.
+        """
+        return False
+
     def parse(self, filename):
         return {}
 
@@ -60,9 +292,136 @@ class RomInfoParser(object):
     def parseBuffer(self, data):
         return {}
 
-    def _getExtension(self, uri):
+    def getCanonicalImage(self, data):
+        """
+        Return (image, transform), describing what hashBuffer() hashes for data
+        (a RomView). image is a RomView of the bytes to hash, e.g. a window
+        skipping a copier header, and transform is None or a function that
+        converts a chunk of image in place. Chunks are CHUNK_SIZE bytes,
+        except for the last one. By default, the whole file is hashed as-is.
+        """
+        return (data, None)
+
+    def hashFile(self, filename, hashes):
+        with self._open(filename) as f:
+            return self.hashBuffer(RomView(f), hashes)
+
+    def hashBuffer(self, data, hashes):
+        """
+        Compute the digests named in hashes ("crc32", or any hashlib algorithm
+        such as "md5" and "sha1") of the canonical image of data in a single
+        streaming pass, reusing one CHUNK_SIZE buffer. Returns a dict of
+        upper case hex digests keyed by name.
+        """
+        if not isinstance(data, RomView):
+            data = RomView(data)
+        (image, transform) = self.getCanonicalImage(data)
+        crc = 0
+        digests = [(name, hashlib.new(name)) for name in hashes if name != "crc32"]
+        buf = bytearray(self.CHUNK_SIZE)
+        pos = 0
+        while pos < len(image):
+            size = image.readinto(pos, buf)
+            if size <= 0:
+                break
+            chunk = buf
+            if transform:
+                if size < len(buf):
+                    chunk = buf[ : size]
+                transform(chunk)
+            block = _getBuffer(chunk, size)
+            if "crc32" in hashes:
+                crc = zlib.crc32(block, crc)
+            for (name, digest) in digests:
+                digest.update(block)
+            pos += size
+        props = dict((name, digest.hexdigest().upper()) for (name, digest) in digests)
+        if "crc32" in hashes:
+            props["crc32"] = "%08X" % (crc & 0xffffffff)
+        return props
+
+    def _sumBytes(self, data, start=0, end=None):
+        """
+        Return the sum of the bytes of data[start : end], where data is a
+        RomView. The range is read and reduced a chunk at a time, by numpy if
+        it is available and by the builtin sum() otherwise.
+        """
+        if end is None or end > len(data):
+            end = len(data)
+        total = 0
+        buf = bytearray(min(self.CHUNK_SIZE, max(end - start, 0)))
+        pos = start
+        while pos < end:
+            size = data.readinto(pos, buf, end - pos)
+            if size <= 0:
+                break
+            if numpy is not None:
+                total += int(numpy.frombuffer(buf, numpy.uint8, size).sum(dtype=numpy.uint64))
+            else:
+                total += sum(buf if size == len(buf) else buf[ : size])
+            pos += size
+        return total
+
+    def _sumWords(self, data, start=0, end=None):
+        """
+        Return the sum of the big-endian 16-bit words of data[start : end],
+        ignoring a trailing odd byte. Like _sumBytes(), the range is reduced a
+        chunk at a time, by numpy or by sum() over an array of words.
+        """
+        if end is None or end > len(data):
+            end = len(data)
+        end -= max(end - start, 0) & 1
+        total = 0
+        buf = bytearray(min(self.CHUNK_SIZE, max(end - start, 0)))
+        pos = start
+        while pos < end:
+            size = data.readinto(pos, buf, end - pos) & ~1
+            if size <= 0:
+                break
+            if numpy is not None:
+                total += int(numpy.frombuffer(buf, ">u2", size >> 1).sum(dtype=numpy.uint64))
+            else:
+                words = array.array("H", bytes(buf[ : size]))
+                if sys.byteorder == "little":
+                    words.byteswap()
+                total += sum(words)
+            pos += size
+        return total
+
+    @staticmethod
+    def _getExtension(uri):
+        # File objects are named by their name attribute, if any
+        uri = getattr(uri, "name", uri)
+        if not hasattr(uri, "rindex"):
+            return ""
         return uri[uri.rindex(".") + 1 : ].lower() if "." in uri else ""
 
+    @contextlib.contextmanager
+    def _open(self, filename):
+        """
+        Open filename for reading in binary mode. filename can also be a
+        seekable binary file object (e.g. a zip archive member), which is
+        rewound and left open.
+        """
+        if hasattr(filename, "read"):
+            filename.seek(0)
+            yield self._instrumentFile(filename, self)
+        else:
+            with open(filename, "rb") as f:
+                yield self._instrumentFile(f, self)
+
+    @staticmethod
+    def _instrumentFile(f, parser):
+        """
+        Return the file object f as-is, or if there are instrumentation hooks,
+        report it as opened by parser (None for RomInfo) and wrap it to
+        report its reads.
+        """
+        if not _hooks:
+            return f
+        _emit("open", parser, filename=getattr(f, "name", None))
+        return InstrumentedFile(f, parser)
+
     def _sanitize(self, title):
         """
         Turn all non-ASCII characters into spaces (tab, CR and LF line breaks
@@ -73,3 +432,182 @@ class RomInfoParser(object):
 
     def _allASCII(self, data):
         return all(0x20 <= b and b <= 0x7E for b in data)
+
+    @staticmethod
+    def _getView(data):
+        """
+        Return data in a form that parsers can index (for ints) and slice (for
+        bytearrays). Bytearrays and RomViews are returned as-is. Anything else
+        (bytes, mmap, memoryview or a seekable binary file object) is wrapped
+        in a RomView, which reads it without copying it first.
+        """
+        return data if isinstance(data, (bytearray, RomView)) else RomView(data)
+
+    def _loadBuffer(self, data):
+        """
+        Return a mutable copy of data (a bytearray or a RomView), for parsers
+        that have to rearrange an image. The caller's data is never modified.
+        """
+        return data.load() if isinstance(data, RomView) else bytearray(data)
+
+
+class RomView(object):
+    """
+    Read-only, bytearray-like view of a ROM image stored in a seekable binary
+    file object or in a buffer (bytearray, bytes, mmap). Indexing returns ints
+    and slicing returns bytearrays, just like the bytearrays that parsers get
+    in parseBuffer(), but only the pages that are actually touched are read
+    from a file. Use load() to get a mutable copy of the whole image when it
+    has to be rearranged (e.g. deinterleaved).
+    """
+
+    # Reads are rounded to pages of this size and cached, so that scoring a
+    # header byte-by-byte only costs one read
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, source, offset=0, size=None):
+        self.source = source
+        self.offset = offset
+        # Buffers are sliced directly, file objects are read through the page cache
+        self.isFile = not hasattr(source, "__getitem__")
+        if size is None:
+            size = self._getSourceSize() - offset
+        self.size = max(size, 0)
+        self.pages = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step == 1:
+                return self.read(start, stop - start)
+            return bytearray(self[i] for i in range(start, stop, step))
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError("RomView index out of range")
+        return self.read(key, 1)[0]
+
+    def read(self, start, length):
+        """
+        Return a bytearray of (up to) length bytes beginning at start.
+        """
+        length = min(length, self.size - start)
+        if start < 0 or length <= 0:
+            return bytearray()
+        pos = self.offset + start
+        if not self.isFile:
+            return bytearray(self.source[pos : pos + length])
+        if length > 4 * self.PAGE_SIZE:
+            # Large reads bypass the page cache
+            self.source.seek(pos)
+            return bytearray(self.source.read(length))
+        first = pos // self.PAGE_SIZE
+        last = (pos + length - 1) // self.PAGE_SIZE
+        if first == last:
+            data = self._getPage(first)
+        else:
+            data = bytearray().join(self._getPage(p) for p in range(first, last + 1))
+        pos -= first * self.PAGE_SIZE
+        return data[pos : pos + length]
+
+    def readinto(self, start, buf, length=None):
+        """
+        Read up to len(buf) (or length) bytes at start into the bytearray buf,
+        returning the number of bytes read. Plain views read straight into buf,
+        views translating addresses (subclasses) go through read().
+        """
+        length = min(len(buf) if length is None else length, len(buf), self.size - start)
+        if start < 0 or length <= 0:
+            return 0
+        if type(self) is not RomView:
+            data = self.read(start, length)
+            buf[ : len(data)] = data
+            return len(data)
+        pos = self.offset + start
+        if not self.isFile:
+            buf[ : length] = self.source[pos : pos + length]
+            return length
+        self.source.seek(pos)
+        if not hasattr(self.source, "readinto"):
+            data = self.source.read(length)
+            buf[ : len(data)] = data
+            return len(data)
+        view = memoryview(buf)
+        count = 0
+        while count < length:
+            size = self.source.readinto(view[count : length])
+            if not size:
+                break
+            count += size
+        return count
+
+    def window(self, offset, size=None):
+        """
+        Return a view of this view's data starting at offset. The new view
+        shares the source and page cache, so nothing is read twice.
+        """
+        if size is None:
+            size = self.size - offset
+        view = RomView(self.source, self.offset + offset, min(size, self.size - offset))
+        view.pages = self.pages
+        return view
+
+    def load(self):
+        """
+        Read the whole view into a new (mutable) bytearray.
+        """
+        return self.read(0, self.size)
+
+    def _getSourceSize(self):
+        if self.isFile:
+            self.source.seek(0, 2)
+            return self.source.tell()
+        return len(self.source)
+
+    def _getPage(self, page):
+        data = self.pages.get(page)
+        if data is None:
+            self.source.seek(page * self.PAGE_SIZE)
+            data = bytearray(self.source.read(self.PAGE_SIZE))
+            self.pages[page] = data
+        return data
+
+
+class InstrumentedFile(object):
+    """
+    Wrapper of a binary file object reporting the bytes read from it to the
+    instrumentation hooks ("read" events), on behalf of parser. Anything
+    but reading is passed through to the file.
+    """
+
+    def __init__(self, f, parser):
+        self.file = f
+        self.parser = parser
+        self.name = getattr(f, "name", None)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        _emit("read", self.parser, filename=self.name, bytes=len(data))
+        return data
+
+    def readinto(self, b):
+        if hasattr(self.file, "readinto"):
+            count = self.file.readinto(b)
+        else:
+            data = self.file.read(len(b))
+            b[ : len(data)] = data
+            count = len(data)
+        _emit("read", self.parser, filename=self.name, bytes=count or 0)
+        return count
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
@@ -14,7 +14,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from rominfo import RomInfoParser
+from rominfo import RomInfoParser, RomView
 
 class SNESParser(RomInfoParser):
     """
@@ -40,14 +40,24 @@ class SNESParser(RomInfoParser):
     def getValidExtensions(self):
         return ["smc", "swc", "fig"]
 
-    def parse(self, filename):
+    def canVerify(self):
+        return True
+
+    def parse(self, filename, verify=False):
         props = {}
-        with open(filename, "rb") as f:
-            data = bytearray(f.read())
+        with self._open(filename) as f:
+            # Only the header windows are read from disk, unless the image
+            # turns out to be interleaved and has to be loaded and converted
+            # or its checksum is verified
+            data = RomView(f)
             if len(data):
-                props = self.parseBuffer(data)
+                props = self.parseBuffer(data, verify)
         return props
 
+    def getCanonicalImage(self, data):
+        # Hash the image without its copier header
+        return (data.window(512) if self.hasSMCHeader(data) else data, None)
+
     def isValidData(self, data):
         if len(data):
             if self.hasSMCHeader(data):
@@ -56,24 +66,35 @@ class SNESParser(RomInfoParser):
             return False
         return False
 
-    def parseBuffer(self, romdata):
+    def parseBuffer(self, romdata, verify=False):
+        """
+        If verify is True, the checksum of the image is calculated and
+        compared to the header's checksum and complement ("checksum_valid").
+        """
         props = {}
         forceInterleavedOff = False
 
+        # romdata is never modified. Header windows are read through a view,
+        # and the image is only copied (see _loadBuffer()) when it has to be
+        # rearranged.
+        if not isinstance(romdata, RomView):
+            romdata = RomView(romdata)
+
         while True:
             # Check for a header (512 bytes), and skip it if found
-            data = romdata[512:] if self.hasSMCHeader(romdata) else romdata[:]
+            data = romdata.window(512 if self.hasSMCHeader(romdata) else 0)
 
-            (hiScore, loScore, extendedFormat, headerOffsetRef) = self.findHiLoMode(data, forceInterleavedOff)
+            (data, hiScore, loScore, extendedFormat, headerOffsetRef) = self.findHiLoMode(data, forceInterleavedOff)
 
             # These two games fail to be detected (Source: Snes9x)
             if data[0x7fc0 : 0x7fc0 + 22] == b"YUYU NO QUIZ DE GO!GO!" or \
                data[0xffc0 : 0xffc0 + 21] == b"BATMAN--REVENGE JOKER":
                 (mapType, interleaved, tales) = (SNESParser.FORMAT_LoROM, False, False)
             else:
-                (mapType, interleaved, tales) = self.findMemoryModel(data[headerOffsetRef : ], hiScore, loScore)
+                (mapType, interleaved, tales) = self.findMemoryModel(data, hiScore, loScore, headerOffsetRef)
 
             if not forceInterleavedOff and interleaved:
+                data = self._loadBuffer(data)
                 mapType = self.convertInterleaved(data, extendedFormat, mapType, tales)
 
                 # Modifying ROM, so we need to re-score
@@ -86,12 +107,15 @@ class SNESParser(RomInfoParser):
                     forceInterleavedOff = True
                     continue
 
-            if tales or extendedFormat == SNESParser.FORMAT_SMALLFIRST:
+            if (tales or extendedFormat == SNESParser.FORMAT_SMALLFIRST) and len(data) > 0x400000:
                 # Fix swapped ExHiROM
-                tmp = data[ : -0x400000]
-                tmp2 = data[-0x400000 : ]
-                data[ : 0x400000] = tmp2
-                data[0x400000 : ] = tmp
+                if isinstance(data, RomView):
+                    data = ExHiROMView(data)
+                else:
+                    tmp = data[ : -0x400000]
+                    tmp2 = data[-0x400000 : ]
+                    data[ : 0x400000] = tmp2
+                    data[0x400000 : ] = tmp
 
             if data[0x7fc0 : 0x7fc0 + 21] == b"Satellaview BS-X     ":
                 bs = True
@@ -113,13 +137,13 @@ class SNESParser(RomInfoParser):
                 headerOffset += 0x400000
             if mapType == SNESParser.FORMAT_HiROM:
                 headerOffset += 0x8000
-            header = data[headerOffset : ]
+            header = data[headerOffset : headerOffset + 0x50]
 
             # Instead of branching on bsHeader, simply apply the different
             # values to the ROM data and use the same code below to set props
             if bsHeader: # The BS game's SRAM was not found
                 # Only use the first 16 of 21 title characters
-                header[0x010 + 16, 0x010 + 21] = b"     "
+                header[0x010 + 16 : 0x010 + 21] = b"     "
                 # Rom speed flag uses 0x28 (RAM size?) instead of 0x25
                 header[0x25] = header[0x28]
                 # Cartridge type is specific to Satellaview BS-X
@@ -182,8 +206,61 @@ class SNESParser(RomInfoParser):
             props["checksum"] = "%04X" % (header[0x2e] + (header[0x2f] << 8))
             props["checksum_complement"] = "%04X" % (header[0x2c] + (header[0x2d] << 8))
 
+            if verify:
+                checksum = header[0x2e] + (header[0x2f] << 8)
+                complement = header[0x2c] + (header[0x2d] << 8)
+                # The BS-X BIOS itself sums like a regular cart (Snes9x's !BSXItself)
+                calculated = self.calculateChecksum(data, bsHeader, headerOffset, "SPC7110" in props["cartridge_type"])
+                props["checksum_valid"] = checksum == calculated and checksum ^ complement == 0xffff
+
             return props
 
+    def calculateChecksum(self, data, bs, headerOffset, spc7110):
+        """
+        Calculate the 16-bit checksum of a deinterleaved image, headerOffset
+        being the offset of its (extended) header (Source: NSRT via Snes9x).
+        bs is only set for BS-X flash carts, not for the BS-X BIOS.
+        """
+        if not isinstance(data, RomView):
+            data = RomView(data)
+        # Like Snes9x (len / 0x2000 * 0x2000), only whole 64 Kbit (8 KB)
+        # blocks are summed; trailing bytes are ignored
+        size = len(data) // 0x2000 * 0x2000
+        if bs:
+            # The header doesn't count for BS-X flash carts
+            total = self._sumBytes(data, 0, size) - self._sumBytes(data, headerOffset, headerOffset + 48)
+        elif spc7110:
+            total = self._sumBytes(data, 0, size)
+            if size == 0x300000:
+                total += total
+        elif size & 0x7fff:
+            total = self._sumBytes(data, 0, size)
+        else:
+            total = self.getMirrorSum(data, 0, size)
+        return total & 0xffff
+
+    def getMirrorSum(self, data, start, length, mask=None):
+        """
+        Sum length bytes at start. If length isn't a power of two, the part
+        after the largest power of two is mirrored until it has that size, the
+        way the image appears in the address space.
+        """
+        if mask is None:
+            mask = 1 << (length.bit_length() - 1) if length else 0
+        while mask and not (length & mask):
+            mask >>= 1
+        if not mask:
+            return 0
+        part1 = self._sumBytes(data, start, start + mask)
+        part2 = 0
+        nextLength = length - mask
+        if nextLength:
+            part2 = self.getMirrorSum(data, start + mask, nextLength, mask >> 1)
+            while nextLength < mask:
+                nextLength += nextLength
+                part2 += part2
+        return part1 + part2
+
     def hasSMCHeader(self, data):
         """
         Check for a 512-byte SMC, SWC or FIG header prepended to the beginning
@@ -210,22 +287,45 @@ class SNESParser(RomInfoParser):
 
     def deinterleaveType1(self, data, size):
         """
-        Swap blocks in a range of ROM memory.
+        Swap blocks in a range of ROM memory. The blocks are copied once, in
+        the order given by getType1BlockOrder(), into a new buffer which then
+        replaces the range.
+        """
+        order = self.getType1BlockOrder(min(size, len(data)))
+        if not order:
+            return
+        src = memoryview(data)
+        out = bytearray(len(order) * 0x8000)
+        for i, block in enumerate(order):
+            out[i * 0x8000 : (i + 1) * 0x8000] = src[block * 0x8000 : (block + 1) * 0x8000]
+        del src
+        data[ : len(out)] = out
+
+    def getType1BlockOrder(self, size):
+        """
+        Return the block permutation of a type 1 interleaved range of size
+        bytes: order[i] is the 32 KB block of the interleaved image that ends
+        up at block i. Blocks past the end of the list are not moved.
+
+        The permutation is the result of the block swapping loop of ZSNES and
+        Snes9x, which is replayed here on block numbers only (keeping track of
+        where each block number is, so that no searching is needed).
         """
         nbanks = size >> 15
         nblocks = nbanks >> 2
         blocks = [(i >> 1) + nblocks if i % 2 == 0 else i >> 1 for i in range(nblocks * 2)]
+        position = [0] * len(blocks)
+        for j, b in enumerate(blocks):
+            position[b] = j
+        order = list(range(nblocks * 2))
         for i in range(nblocks * 2):
-            for j in range(nblocks * 2):
-                if blocks[j] == i:
-                    tmp = data[blocks[j] * 0x8000 : blocks[j] * 0x8000 + 0x8000]
-                    data[blocks[j] * 0x8000 : blocks[j] * 0x8000 + 0x8000] = \
-                        data[blocks[i] * 0x8000 : blocks[i] * 0x8000 + 0x8000]
-                    data[blocks[i] * 0x8000 : blocks[i] * 0x8000 + 0x8000] = tmp
-                    b = blocks[j]
-                    blocks[j] = blocks[i]
-                    blocks[i] = b
-                    break
+            j = position[i]
+            # Swap the data blocks at i (== blocks[j]) and blocks[i]
+            order[i], order[blocks[i]] = order[blocks[i]], order[i]
+            blocks[i], blocks[j] = blocks[j], blocks[i]
+            position[blocks[i]] = i
+            position[blocks[j]] = j
+        return order
 
     def findHiLoMode(self, data, forceInterleavedOff):
         hiScore = self.scoreHiRom(data)
@@ -236,8 +336,8 @@ class SNESParser(RomInfoParser):
         if len(data) > 0x400000 and \
                 data[0x7fd5] + (data[0x7fd6] << 8) not in [0x3423, 0x3523, 0x4332, 0x4532] and \
                 data[0xffd5] + (data[0xffd6] << 8) not in [0xf93a, 0xf53a]:
-            swappedHiRom = self.scoreHiROM(data, 0x400000)
-            swappedLoRom = self.scoreLoROM(data, 0x400000)
+            swappedHiRom = self.scoreHiRom(data, 0x400000)
+            swappedLoRom = self.scoreLoRom(data, 0x400000)
             if max(swappedLoRom, swappedHiRom) >= max(loScore, hiScore):
                 extendedFormat = SNESParser.FORMAT_BIGFIRST
                 hiScore = swappedHiRom
@@ -249,17 +349,21 @@ class SNESParser(RomInfoParser):
         elif data[0x7ffc] + (data[0x7ffd] << 8) < 0x8000 and \
              data[0xfffc] + (data[0xfffd] << 8) < 0x8000 and not forceInterleavedOff:
             # If both vectors are invalid, it's type 1 interleaved LoROM
-            self.deinterleaveType1(data, len(data));
+            if isinstance(data, RomView):
+                # Only the blocks that get scored are read
+                data = Type1View(data, self.getType1BlockOrder(len(data)))
+            else:
+                self.deinterleaveType1(data, len(data))
             # Modifying ROM, so we need to re-score
             hiScore = self.scoreHiRom(data)
             loScore = self.scoreLoRom(data)
 
-        return (hiScore, loScore, extendedFormat, headerOffsetRef,)
+        return (data, hiScore, loScore, extendedFormat, headerOffsetRef,)
 
-    def findMemoryModel(self, data, hiScore, loScore):
+    def findMemoryModel(self, data, hiScore, loScore, offset=0):
         """
         Determine if the ROM is a LoROM Memory Model (32k Banks) or HiROM
-        Memory Model (64k Banks).
+        Memory Model (64k Banks). The header is looked for at offset.
         """
         mapType = None # SNESParser.FORMAT_LoROM or SNESParser.FORMAT_HiROM
         interleaved = False
@@ -268,16 +372,18 @@ class SNESParser(RomInfoParser):
         if loScore >= hiScore:
             mapType = SNESParser.FORMAT_LoROM
             # Ignore map type byte if not 0x2x or 0x3x
-            if data[0x7fd5] & 0xf0 in [0x20, 0x30]:
-                if data[0x7fd5] & 0x0f == 1:
+            mapMode = data[0x7fd5 + offset]
+            if mapMode & 0xf0 in [0x20, 0x30]:
+                if mapMode & 0x0f == 1:
                     interleaved = True
-                elif data[0x7fd5] & 0x0f == 5:
+                elif mapMode & 0x0f == 5:
                     interleaved = True
                     tales = True
         else:
             mapType = SNESParser.FORMAT_HiROM
-            if data[0xffd5] & 0xf0 in [0x20, 0x30]:
-                if data[0xffd5] & 0x0f in [0, 3]:
+            mapMode = data[0xffd5 + offset]
+            if mapMode & 0xf0 in [0x20, 0x30]:
+                if mapMode & 0x0f in [0, 3]:
                     interleaved = True
 
         return (mapType, interleaved, tales,)
@@ -303,7 +409,7 @@ class SNESParser(RomInfoParser):
 
     def scoreHiRom(self, data, offset=0):
         size = len(data)
-        data = data[0xff00 + offset : ]
+        data = data[0xff00 + offset : 0xff00 + offset + 0x100]
         score = 0
 
         if data[0xd4] == 0x20:
@@ -337,7 +443,7 @@ class SNESParser(RomInfoParser):
 
     def scoreLoRom(self, data, offset=0):
         size = len(data)
-        data = data[0x7f00 + offset : ]
+        data = data[0x7f00 + offset : 0x7f00 + offset + 0x100]
         score = 0
 
         if not (data[0xd5] & 0x1):
@@ -454,6 +560,53 @@ class SNESParser(RomInfoParser):
 RomInfoParser.registerParser(SNESParser())
 
 
+class ExHiROMView(RomView):
+    """
+    View of an ExHiROM image with its last 4 MB (32 Mbit) moved to the front,
+    without reading or copying the image. This is the view equivalent of the
+    "Fix swapped ExHiROM" step in SNESParser.parseBuffer().
+    """
+
+    def __init__(self, view):
+        RomView.__init__(self, view.source, view.offset, view.size)
+        self.pages = view.pages
+        self.view = view
+        self.split = view.size - 0x400000
+
+    def read(self, start, length):
+        if start >= 0x400000:
+            return self.view.read(start - 0x400000, length)
+        data = self.view.read(start + self.split, min(length, 0x400000 - start))
+        if start + length > 0x400000:
+            data += self.view.read(0, start + length - 0x400000)
+        return data
+
+
+class Type1View(RomView):
+    """
+    View of a type 1 interleaved image in deinterleaved order, given the block
+    order from SNESParser.getType1BlockOrder(). Reads are translated block by
+    block, so only the 32 KB blocks that are looked at get read.
+    """
+
+    def __init__(self, view, order):
+        RomView.__init__(self, view.source, view.offset, view.size)
+        self.pages = view.pages
+        self.view = view
+        self.order = order
+
+    def read(self, start, length):
+        end = min(start + length, self.size)
+        parts = []
+        while start < end:
+            block = start >> 15
+            stop = min(end, (block + 1) << 15)
+            src = self.order[block] if block < len(self.order) else block
+            parts.append(self.view.read((src << 15) + (start & 0x7fff), stop - start))
+            start = stop
+        return bytearray().join(parts)
+
+
 # Souce: http://softpixel.com/~cwright/sianse/docs/Snesrom.txt
 # Snesrom.txt correction: South Korea should be NTSC
 snes_regions = {
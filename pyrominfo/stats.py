@@ -0,0 +1,343 @@
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import os
+import bisect
+import threading
+import collections
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from rominfo import _clock
+
+class ParserCounters(object):
+    """
+    Instrumentation hook aggregating the events of RomInfoParser.addHook()
+    per parser class. Work that isn't a parser's own (picking parsers and
+    sniffing files) is counted under None, which also gets the misses:
+
+        counters = ParserCounters()
+        RomInfoParser.addHook(counters)
+        for path, props in RomInfo.scan("/roms", executor="thread"):
+            ...
+        RomInfoParser.removeHook(counters)
+        for name, c in counters.getCounters().items():
+            print(name, c["parses"], c["parse_time"], c["bytes_read"])
+
+    Counters are updated under a lock, so one instance can be shared by the
+    threads of a scan. Process workers have hooks of their own.
+    """
+
+    FIELDS = (
+        "dispatches",    # Files parsers were looked up for (None only)
+        "validations",   # Signature matches and isValidData() probes
+        "valid",         # ... that accepted the data
+        "validate_time", # Seconds spent in isValidData()
+        "opens",         # Files opened
+        "reads",         # Read calls
+        "bytes_read",    # Bytes read
+        "parses",        # Calls to parse() or parseBuffer()
+        "parse_time",    # Seconds spent in them
+        "errors",        # ... that raised
+        "found",         # Files the parser returned props for
+        "misses",        # Files no parser returned props for (None only)
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def __call__(self, event, parser, details):
+        name = type(parser).__name__ if parser is not None else None
+        with self.lock:
+            counters = self.counters.get(name)
+            if counters is None:
+                counters = self.counters[name] = dict.fromkeys(self.FIELDS, 0)
+            if event == "read":
+                counters["reads"] += 1
+                counters["bytes_read"] += details["bytes"]
+            elif event == "open":
+                counters["opens"] += 1
+            elif event == "validate":
+                counters["validations"] += 1
+                counters["valid"] += details["valid"]
+                counters["validate_time"] += details.get("duration", 0)
+            elif event == "parse":
+                counters["parses"] += 1
+                counters["parse_time"] += details["duration"]
+                counters["errors"] += details["error"] is not None
+            elif event == "dispatch":
+                counters["dispatches"] += 1
+            elif event == "result":
+                counters["found" if details["found"] else "misses"] += 1
+
+    def getCounters(self):
+        """
+        Return a copy of the counters, a dict of FIELDS dicts by parser class
+        name (None for RomInfo).
+        """
+        with self.lock:
+            return dict((name, dict(counters)) for (name, counters) in self.counters.items())
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+class ScanMetrics(object):
+    """
+    Instrumentation hook keeping the metrics of long-running scans, rendered
+    in the OpenMetrics text format that Prometheus scrapes:
+
+        pyrominfo_files_total              Files parsed (or tried)
+        pyrominfo_found_total              ... recognized, by parser
+        pyrominfo_misses_total             ... no parser recognized, for which
+                                           RomInfo.parse() returned {}
+        pyrominfo_errors_total             parse() calls that raised, by parser
+        pyrominfo_read_bytes_total         Bytes read
+        pyrominfo_files_per_second         Files and bytes per second over the
+        pyrominfo_read_bytes_per_second    last window seconds
+        pyrominfo_parse_duration_seconds   Histogram of parse() times, by parser
+
+    Serve them over HTTP with MetricsServer, or write them to a file every so
+    often with MetricsWriter (e.g. for node_exporter's textfile collector):
+
+        metrics = ScanMetrics()
+        RomInfoParser.addHook(metrics)
+        with MetricsServer(metrics, 9464):
+            for path, props in RomInfo.scan("/roms", executor="thread"):
+                ...
+
+    Like ParserCounters, process workers have hooks of their own, so scan
+    with executor="thread" to see their work.
+    """
+
+    # Upper bounds of the parse duration histogram buckets, in seconds
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, window=60, buckets=BUCKETS):
+        self.window = window
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = _clock()
+            self.files = 0
+            self.misses = 0
+            self.bytesRead = 0
+            self.found = {}
+            self.errors = {}
+            # Parser name -> [counts per bucket (the last one is +Inf), sum]
+            self.durations = {}
+            # [second, files, bytes] of the last window seconds
+            self.recent = collections.deque()
+
+    def __call__(self, event, parser, details):
+        if event == "read":
+            with self.lock:
+                self.bytesRead += details["bytes"]
+                self._getRecent(details["time"])[2] += details["bytes"]
+        elif event == "dispatch":
+            with self.lock:
+                self.files += 1
+                self._getRecent(details["time"])[1] += 1
+        elif event == "parse":
+            name = type(parser).__name__
+            with self.lock:
+                histogram = self.durations.get(name)
+                if histogram is None:
+                    histogram = self.durations[name] = [[0] * (len(self.buckets) + 1), 0.0]
+                histogram[0][bisect.bisect_left(self.buckets, details["duration"])] += 1
+                histogram[1] += details["duration"]
+                if details["error"] is not None:
+                    self.errors[name] = self.errors.get(name, 0) + 1
+        elif event == "result":
+            with self.lock:
+                if parser is None:
+                    self.misses += 1
+                else:
+                    name = type(parser).__name__
+                    self.found[name] = self.found.get(name, 0) + 1
+
+    def _getRecent(self, time):
+        """
+        Return the [second, files, bytes] entry of recent for time, dropping
+        the ones that fell out of the window. Call with the lock held.
+        """
+        second = int(time)
+        # Events from threads (or a clock stepping back) may come slightly
+        # out of order, and are counted in the latest second
+        if not self.recent or self.recent[-1][0] < second:
+            self.recent.append([second, 0, 0])
+            while self.recent[0][0] <= second - self.window:
+                self.recent.popleft()
+        return self.recent[-1]
+
+    def getRates(self):
+        """
+        Return (files/s, bytes/s) over the last window seconds, or since the
+        metrics were created or reset if that is less.
+        """
+        with self.lock:
+            now = _clock()
+            oldest = now - self.window
+            (files, bytesRead) = (0, 0)
+            for (second, f, b) in self.recent:
+                if second > oldest - 1:
+                    files += f
+                    bytesRead += b
+            # Rates are kept per second, so don't extrapolate from less
+            elapsed = min(self.window, max(1.0, now - self.start))
+        return (files / elapsed, bytesRead / elapsed)
+
+    def render(self):
+        """
+        Return the metrics in the OpenMetrics text format.
+        """
+        (filesPerSec, bytesPerSec) = self.getRates()
+        with self.lock:
+            lines = []
+            _addFamily(lines, "pyrominfo_files", "counter", "Files parsed or tried.",
+                       [("_total", {}, self.files)])
+            _addFamily(lines, "pyrominfo_found", "counter", "Files recognized, by parser.",
+                       [("_total", {"parser": name}, count) for (name, count) in sorted(self.found.items())])
+            _addFamily(lines, "pyrominfo_misses", "counter", "Files no parser recognized.",
+                       [("_total", {}, self.misses)])
+            _addFamily(lines, "pyrominfo_errors", "counter", "Parser calls that raised, by parser.",
+                       [("_total", {"parser": name}, count) for (name, count) in sorted(self.errors.items())])
+            _addFamily(lines, "pyrominfo_read_bytes", "counter", "Bytes read from ROM files.",
+                       [("_total", {}, self.bytesRead)], unit="bytes")
+            _addFamily(lines, "pyrominfo_files_per_second", "gauge",
+                       "Files parsed or tried per second over the last %d seconds." % self.window,
+                       [("", {}, filesPerSec)])
+            _addFamily(lines, "pyrominfo_read_bytes_per_second", "gauge",
+                       "Bytes read per second over the last %d seconds." % self.window,
+                       [("", {}, bytesPerSec)])
+            samples = []
+            for (name, (counts, total)) in sorted(self.durations.items()):
+                cumulative = 0
+                for (bound, count) in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append(("_bucket", {"parser": name, "le": bound}, cumulative))
+                samples.append(("_count", {"parser": name}, cumulative))
+                samples.append(("_sum", {"parser": name}, total))
+            _addFamily(lines, "pyrominfo_parse_duration_seconds", "histogram",
+                       "Time spent in parse() and parseBuffer(), by parser.", samples, unit="seconds")
+        lines.append("# EOF\n")
+        return "".join(lines)
+
+    def write(self, filename):
+        """
+        Write the metrics to filename, replacing it atomically so that readers
+        never see half a file.
+        """
+        temp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp, "wb") as f:
+            f.write(self.render().encode("utf-8"))
+        if os.name == "nt" and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+
+def _addFamily(lines, name, kind, help, samples, unit=None):
+    """
+    Append the lines of a metric family to lines. samples is a list of
+    (suffix, labels, value) tuples.
+    """
+    lines.append("# TYPE %s %s\n" % (name, kind))
+    if unit:
+        lines.append("# UNIT %s %s\n" % (name, unit))
+    lines.append("# HELP %s %s\n" % (name, help))
+    for (suffix, labels, value) in samples:
+        if labels:
+            labels = "{%s}" % ",".join('%s="%s"' % (key, _escapeLabel(_formatValue(labels[key])))
+                                       for key in sorted(labels, key=lambda key: key == "le"))
+        else:
+            labels = ""
+        lines.append("%s%s%s %s\n" % (name, suffix, labels, _formatValue(value)))
+
+def _formatValue(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+def _escapeLabel(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class MetricsServer(object):
+    """
+    Serve the OpenMetrics text of a ScanMetrics on http://host:port/metrics
+    from a background thread, until close() (or the end of a with block).
+    host defaults to the loopback interface; port 0 picks a free port, see
+    the port attribute.
+    """
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", MetricsServer.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class MetricsWriter(object):
+    """
+    Write the metrics of a ScanMetrics to filename every interval seconds
+    from a background thread (see ScanMetrics.write()), and a last time on
+    close() (or at the end of a with block).
+    """
+
+    def __init__(self, metrics, filename, interval=15):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.write(self.filename)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.write(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
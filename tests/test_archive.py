@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import testutils
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+archive = testutils.loadModule("archive")
+gameboy = testutils.loadModule("gameboy")
+gba = testutils.loadModule("gba")
+nintendo64 = testutils.loadModule("nintendo64")
+
+from pyrominfo import RomInfo
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "roms.zip")
+        with zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("readme.txt", "Not a ROM")
+            with open("data/Tetris.gb", "rb") as f:
+                # Pad to 1 MB, to check how much of the member is inflated
+                z.writestr("Tetris.gb", f.read() + b"\xff" * (0x100000 - 336))
+            z.write("data/Super Smash Bros.z64", "n64/Super Smash Bros.z64")
+            z.write("data/Golden Sun - The Lost Age.gba", "Golden Sun.rom")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_split(self):
+        self.assertEqual(archive.splitArchivePath(self.filename), (self.filename, ""))
+        self.assertEqual(archive.splitArchivePath(self.filename + "/n64/Super Smash Bros.z64"),
+                         (self.filename, "n64/Super Smash Bros.z64"))
+        self.assertEqual(archive.splitArchivePath("data/Tetris.gb"), ("data/Tetris.gb", None))
+        self.assertEqual(archive.splitArchivePath("missing.zip/Tetris.gb"), ("missing.zip/Tetris.gb", None))
+
+    def test_parse(self):
+        self.assertEqual(RomInfo.parse(self.filename)["title"], "TETRIS")
+        self.assertEqual(RomInfo.parse(self.filename + "/Tetris.gb")["title"], "TETRIS")
+        self.assertEqual(RomInfo.parse(self.filename + "/n64/Super Smash Bros.z64")["title"], "SMASH BROTHERS")
+        # Unknown extensions are identified by their contents
+        self.assertEqual(RomInfo.parse(self.filename + "/Golden Sun.rom")["title"], "GOLDEN_SUN_B")
+        self.assertEqual(RomInfo.parse(self.filename + "/readme.txt"), {})
+        self.assertRaises(KeyError, RomInfo.parse, self.filename + "/missing.gb")
+
+        # Members hash like the files they were made from
+        props = RomInfo.parse(self.filename + "/n64/Super Smash Bros.z64", hashes=["crc32", "sha1"])
+        expected = RomInfo.parse("data/Super Smash Bros.z64", hashes=["crc32", "sha1"])
+        self.assertEqual(props, expected)
+
+    def test_member(self):
+        with zipfile.ZipFile(self.filename) as z:
+            with archive.ZipMemberFile(z, "Tetris.gb") as f:
+                props = gameboy.GameboyParser().parse(f)
+                self.assertEqual(props["title"], "TETRIS")
+                # Only the header was inflated
+                self.assertEqual(f.streamPos, 0x150)
+
+                f.seek(-4, 2)
+                self.assertEqual(f.read(), b"\xff" * 4)
+                f.seek(0x134)
+                self.assertEqual(f.read(6), b"TETRIS")
+                self.assertEqual(f.tell(), 0x13a)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import testutils
+
+import os
+import shutil
+import tempfile
+import unittest
+
+gameboy = testutils.loadModule("gameboy")
+cache = testutils.loadModule("cache")
+
+from pyrominfo import RomInfo
+
+class TestRomInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, "roms.db")
+        self.romfile = os.path.join(self.tmpdir, "Tetris.gb")
+        shutil.copy("data/Tetris.gb", self.romfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        with cache.RomInfoCache(self.dbfile) as c:
+            self.assertEqual(c.get(self.romfile), None)
+            props = RomInfo.parse(self.romfile, cache=c)
+            self.assertEqual(props["title"], "TETRIS")
+            self.assertEqual(c.get(self.romfile), props)
+
+        # Entries persist, and are invalidated by file changes...
+        with cache.RomInfoCache(self.dbfile) as c:
+            self.assertEqual(c.get(self.romfile), props)
+            st = os.stat(self.romfile)
+            os.utime(self.romfile, (st.st_atime, st.st_mtime + 10))
+            self.assertEqual(c.get(self.romfile), None)
+            c.put(self.romfile, props)
+
+        # Unverified entries don't serve verified lookups
+        with cache.RomInfoCache(self.dbfile) as c:
+            self.assertEqual(c.get(self.romfile, verify=True), None)
+            verified = RomInfo.parse(self.romfile, cache=c, verify=True)
+            self.assertTrue("global_checksum_valid" in verified)
+            self.assertEqual(c.get(self.romfile, verify=True), verified)
+            self.assertEqual(c.get(self.romfile), verified)
+
+        # ...and by parser changes
+        with cache.RomInfoCache(self.dbfile, version="other") as c:
+            self.assertEqual(len(c), 0)
+
+    def test_eviction(self):
+        roms = []
+        for i in range(4):
+            roms.append(os.path.join(self.tmpdir, "%d.gb" % i))
+            shutil.copy("data/Tetris.gb", roms[-1])
+        with cache.RomInfoCache(self.dbfile, maxEntries=2) as c:
+            results = dict(RomInfo.scan(roms, workers=2, cache=c))
+            self.assertEqual(len(results), 4)
+            self.assertEqual(c.get(roms[0])["title"], "TETRIS")
+        with cache.RomInfoCache(self.dbfile, maxEntries=2) as c:
+            self.assertEqual(len(c), 2)
+            self.assertNotEqual(c.get(roms[0]), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 Jan Holthuis
+# See Copyright Notice in rominfo.py
+
+import testutils
+
+import datetime
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+dreamcast = testutils.loadModule("dreamcast")
+
+from pyrominfo.rominfo import RomInfoParser
+
+IP_BIN = testutils.makeIPBin()
+makeCDI = testutils.makeCDI
+
+class TestDreamcastParser(unittest.TestCase):
+    def setUp(self):
+        self.dcParser = dreamcast.DreamcastParser()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cdi(self):
+        tracks = [
+            [(0, 2, 2, 3, 0, b"")],
+            [(2, 1, 150, 4, 11702, b"\x00" * 8 + IP_BIN)],
+        ]
+        for version in [dreamcast.CDI_V2, dreamcast.CDI_V3, dreamcast.CDI_V35]:
+            filename = os.path.join(self.tmpdir, "test.cdi")
+            with open(filename, "wb") as f:
+                f.write(makeCDI(version, tracks))
+            props = self.dcParser.parse(filename)
+            self.assertEqual(props["game_title"], "TEST TITLE")
+            self.assertEqual(props["product_id"], "T-1234M")
+            self.assertEqual(props["release_date"], datetime.date(2000, 1, 1))
+            self.assertEqual(props["regions"], ("Asia", "America", "Europe"))
+            self.assertEqual(props["tracks"], (
+                {"index": 1, "session": 1, "mode": "audio", "sector_size": 2352,
+                 "lba": 0, "pregap": 2, "length": 3, "offset": 2 * 2352},
+                {"index": 2, "session": 2, "mode": "mode2", "sector_size": 2336,
+                 "lba": 11702, "pregap": 150, "length": 4, "offset": 5 * 2352 + 150 * 2336},
+            ))
+
+            # Also from a file object without a name
+            with open(filename, "rb") as f:
+                self.assertEqual(self.dcParser.parse(io.BytesIO(f.read())), props)
+
+        # Missing data track
+        with open(filename, "wb") as f:
+            f.write(makeCDI(dreamcast.CDI_V3, tracks[ : 1]))
+        self.assertEqual(self.dcParser.parse(filename), {})
+
+        # Truncated descriptors
+        with open(filename, "wb") as f:
+            f.write(struct.pack("<HH", 1, 1) + struct.pack("<II", dreamcast.CDI_V35, 12))
+        self.assertEqual(self.dcParser.parse(filename), {})
+
+        # A corrupt descriptor offset is rejected instead of reading the image
+        image = bytearray(makeCDI(dreamcast.CDI_V3, [[(2, 0, 0, 512, 0, IP_BIN)]]))
+        image[-4 : ] = struct.pack("<I", 16)
+        with open(filename, "wb") as f:
+            f.write(image)
+        reads = []
+        hook = lambda event, parser, details: event == "read" and reads.append(details["bytes"])
+        RomInfoParser.addHook(hook)
+        try:
+            self.assertEqual(self.dcParser.parse(filename), {})
+        finally:
+            RomInfoParser.removeHook(hook)
+        self.assertEqual(reads, [8])
+
+    def test_gdi(self):
+        self.dcParser.GDI_CACHE_SIZE = 1
+        # Raw sectors: sync pattern, address, mode 1, user data and EDC/ECC
+        raw = dreamcast.cd_sector_sync + b"\x00\x02\x00\x01" + IP_BIN.ljust(2048, b"\x00") + b"\xee" * 288
+        for sector_size, sector in [(2352, raw), (2048, IP_BIN.ljust(2048, b"\x00"))]:
+            filename = os.path.join(self.tmpdir, "disc %d.gdi" % sector_size)
+            with open(filename, "w") as f:
+                f.write("3\n")
+                f.write("1     0 4 2352 track01.bin 0\n")
+                f.write("2   756 0 2352 track02.raw 0\n")
+                f.write("3 45000 4 %d \"track 03.bin\" 0\n" % sector_size)
+            with open(os.path.join(self.tmpdir, "track 03.bin"), "wb") as f:
+                f.write(sector * 2)
+
+            props = self.dcParser.parse(filename)
+            self.assertEqual(props["game_title"], "TEST TITLE")
+            self.assertEqual(props["tracks"][1], {"index": 2, "lba": 756, "mode": "audio", "sector_size": 2352,
+                                                  "file": os.path.join(self.tmpdir, "track02.raw"), "offset": 0})
+            track = props["tracks"][2]
+            self.assertEqual((track["index"], track["lba"], track["mode"], track["sector_size"]),
+                             (3, 45000, "mode1", sector_size))
+            self.assertEqual(self.dcParser._read_user_data(track, 0, 2), IP_BIN.ljust(2048, b"\x00") * 2)
+
+            # The track table is parsed once per version of the file
+            tracks = self.dcParser._get_gdi_tracks(filename)
+            self.assertTrue(self.dcParser._get_gdi_tracks(filename) is tracks)
+            with open(filename, "a") as f:
+                f.write("\n")
+            self.assertFalse(self.dcParser._get_gdi_tracks(filename) is tracks)
+
+        # Unquoted names are taken as they are, and bad quoting is a bad row
+        filename = os.path.join(self.tmpdir, "apostrophe.gdi")
+        shutil.copy(os.path.join(self.tmpdir, "track 03.bin"), os.path.join(self.tmpdir, "track03's#1.bin"))
+        with open(filename, "w") as f:
+            f.write("3\n1 0 4 2352 track01.bin 0\n2 756 0 2352 track02.raw 0\n3 45000 4 2048 track03's#1.bin 0\n")
+        self.assertEqual(self.dcParser.parse(filename)["game_title"], "TEST TITLE")
+        with open(filename, "w") as f:
+            f.write("3\n1 0 4 2352 track01.bin 0\n2 756 0 2352 track02.raw 0\n3 45000 4 2048 \"track03.bin 0\n")
+        self.assertEqual(self.dcParser.parse(filename), {})
+        self.dcParser._gdi_tracks.clear()
+        self.dcParser.parse(os.path.join(self.tmpdir, "disc 2048.gdi"))
+
+        # Only the last table used is kept
+        self.assertEqual(list(self.dcParser._gdi_tracks), [os.path.join(self.tmpdir, "disc 2048.gdi")])
+
+if __name__ == '__main__':
+    unittest.main()
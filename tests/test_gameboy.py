@@ -35,5 +35,25 @@ class TestGameboyParser(unittest.TestCase):
         self.assertEqual(props["header_checksum"], "3C")
         self.assertEqual(props["global_checksum"], "E3FD")
 
+    def test_gameboy_checksums(self):
+        props = self.gbParser.parse("data/The Legend of Zelda - Links Awakening DX.gbc", verify=True)
+        self.assertTrue(props["header_checksum_valid"])
+        # Only the header of this image is included
+        self.assertFalse(props["global_checksum_valid"])
+
+        with open("data/Tetris.gb", "rb") as f:
+            data = bytearray(f.read()) + bytearray(range(256)) * 128
+        self.assertFalse("header_checksum_valid" in self.gbParser.parseBuffer(data))
+        checksum = (sum(data) - data[0x14e] - data[0x14f]) & 0xffff
+        data[0x14e : 0x150] = bytearray([checksum >> 8, checksum & 0xff])
+        props = self.gbParser.parseBuffer(data, verify=True)
+        self.assertTrue(props["header_checksum_valid"])
+        self.assertTrue(props["global_checksum_valid"])
+
+        data[0x150] ^= 0xff
+        self.assertFalse(self.gbParser.parseBuffer(data, verify=True)["global_checksum_valid"])
+        data[0x134] ^= 0xff
+        self.assertFalse(self.gbParser.parseBuffer(data, verify=True)["header_checksum_valid"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -28,5 +28,26 @@ class TestGBAParser(unittest.TestCase):
         self.assertEqual(props["header_checksum"], "2E")
         self.assertEqual(props["platform"], "Game Boy Advance")
 
+    def test_gba_verify(self):
+        props = self.gbaParser.parse("data/Golden Sun - The Lost Age.gba", verify=True)
+        self.assertTrue(props["header_checksum_valid"])
+        self.assertEqual(props["trimmed_size"] + props["padding_bytes"], 0xc0)
+
+        with open("data/Golden Sun - The Lost Age.gba", "rb") as f:
+            data = bytearray(f.read()) + bytearray(range(1, 255)) * 3
+        size = len(data)
+        data += b"\xff" * 0x2345
+        # Scan across several blocks
+        self.gbaParser.CHUNK_SIZE = 0x1000
+        props = self.gbaParser.parseBuffer(data, verify=True)
+        self.assertEqual(props["trimmed_size"], size)
+        self.assertEqual(props["padding_bytes"], 0x2345)
+        self.assertEqual(self.gbaParser.getTrimmedSize(data[ : size] + b"\x00" * 0x1000), size)
+        self.assertEqual(self.gbaParser.getTrimmedSize(data[ : size]), size)
+        self.assertEqual(self.gbaParser.getTrimmedSize(b"\xff" * 0x3000), 0)
+
+        data[0xa0] ^= 0xff
+        self.assertFalse(self.gbaParser.parseBuffer(data, verify=True)["header_checksum_valid"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,7 @@
 
 import testutils
 
+import io
 import unittest
 
 genesis = testutils.loadModule("genesis")
@@ -34,5 +35,61 @@ class TestGenesisParser(unittest.TestCase):
         self.assertEqual(props["memo"], "")
         self.assertEqual(props["country_codes"], "JUE")
 
+    def test_genesis_interleaved(self):
+        rom = bytearray(b" " * 0x10000)
+        rom[0x100 : 0x100 + 16] = b"SEGA MEGA DRIVE "
+        rom[0x110 : 0x110 + 16] = b"(C)SEGA 1991.APR"
+        rom[0x150 : 0x150 + 16] = b"SONIC THE       "
+        rom[0x180 : 0x180 + 2] = b"GM"
+        rom[0x18e : 0x18e + 2] = b"\x26\x4a"
+        plain = self.genesisParser.parseBuffer(rom)
+        self.assertEqual(plain["title"], "SONIC THE")
+        self.assertEqual(plain["checksum"], "264A")
+
+        # SMD: 512-byte header, then 16 KB blocks of odd bytes followed by even bytes
+        smd = bytearray(0x200)
+        smd[0x08 : 0x0b] = b"\xAA\xBB\x06"
+        for i in range(0, len(rom), 0x4000):
+            smd += rom[i + 1 : i + 0x4000 : 2] + rom[i : i + 0x4000 : 2]
+        view = genesis.RomView(io.BytesIO(bytes(smd)))
+        self.assertEqual(self.genesisParser.parseBuffer(view), plain)
+        # Only the SMD header and the halves of the first block are read
+        self.assertEqual(len(view.pages), 2)
+
+        # MD: all odd bytes followed by all even bytes
+        md = rom[1 : : 2] + rom[0 : : 2]
+        self.assertEqual(self.genesisParser.parseBuffer(md), plain)
+
+        # Interleaved images hash the same as the plain image, also when
+        # deinterleaved a chunk at a time
+        hashes = self.genesisParser.hashBuffer(rom, ["crc32", "md5"])
+        self.assertEqual(self.genesisParser.hashBuffer(md, ["crc32", "md5"]), hashes)
+        self.genesisParser.CHUNK_SIZE = 0x4000
+        self.assertEqual(self.genesisParser.hashBuffer(io.BytesIO(bytes(smd)), ["crc32", "md5"]), hashes)
+
+    def test_genesis_checksum(self):
+        rom = bytearray(range(256)) * 0x100
+        rom[0x100 : 0x100 + 16] = b"SEGA MEGA DRIVE "
+        checksum = sum((rom[i] << 8) + rom[i + 1] for i in range(0x200, len(rom), 2)) & 0xffff
+        rom[0x18e : 0x18e + 2] = bytearray([checksum >> 8, checksum & 0xff])
+        props = self.genesisParser.parseBuffer(rom, verify=True)
+        self.assertEqual(props["calculated_checksum"], "%04X" % checksum)
+        self.assertTrue(props["checksum_valid"])
+        self.assertFalse("checksum_valid" in self.genesisParser.parseBuffer(rom))
+
+        # The checksum is calculated over the deinterleaved SMD image
+        smd = bytearray(0x200)
+        smd[0x08 : 0x0b] = b"\xAA\xBB\x06"
+        for i in range(0, len(rom), 0x4000):
+            smd += rom[i + 1 : i + 0x4000 : 2] + rom[i : i + 0x4000 : 2]
+        self.genesisParser.CHUNK_SIZE = 0x4000
+        view = genesis.RomView(io.BytesIO(bytes(smd)))
+        self.assertEqual(self.genesisParser.parseBuffer(view, verify=True), props)
+        # Summing the blocks doesn't fill the page cache with the image
+        self.assertTrue(len(view.pages) <= 4)
+
+        rom[0x201] ^= 0xff
+        self.assertFalse(self.genesisParser.parseBuffer(rom, verify=True)["checksum_valid"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import testutils
+
+import io
+import unittest
+
+mastersystem = testutils.loadModule("mastersystem")
+
+class TestMasterSystemParser(unittest.TestCase):
+    def setUp(self):
+        self.smsParser = mastersystem.MasterSystemParser()
+
+    def test_mastersystem(self):
+        empty = self.smsParser.parse("data/empty")
+        self.assertEqual(len(empty), 0)
+
+        # 256 KB homebrew image with a SEGA header and an SDSC header
+        data = bytearray(0x40000)
+        data[0x7ff0 : 0x8000] = b"TMR SEGA\xff\xff\x12\x34\x26\x70\x00\x40"
+        data[0x7fe0 : 0x7ff0] = b"SDSC\x01\x02\x31\x12\x01\x20\x01\x00\x01\x10\x30\x00"
+        data[0x0100 : 0x0107] = b"Author\x00"
+        data[0x0110 : 0x0116] = b"Title\x00"
+        data[0x3000 : 0x3000 + 0x2000] = b"A" * 0x2000
+
+        view = mastersystem.RomView(io.BytesIO(bytes(data)))
+        props = self.smsParser.parseBuffer(view)
+        self.assertEqual(props, self.smsParser.parseBuffer(data))
+        self.assertEqual(props["header_id"], "TMR SEGA")
+        self.assertEqual(props["checksum"], "1234")
+        self.assertEqual(props["code"], "007026")
+        self.assertEqual(props["console"], "Sega Master System")
+        self.assertEqual(props["region"], "Export")
+        self.assertEqual(props["rom_size"], "256 KB")
+        self.assertEqual(props["version"], "1.02")
+        self.assertEqual(props["date"], "2001-12-31")
+        self.assertEqual(props["author"], "Author")
+        self.assertEqual(props["title"], "Title")
+        # The unterminated description is capped at MAX_STRING_LENGTH bytes
+        self.assertEqual(props["description"], "A" * self.smsParser.MAX_STRING_LENGTH)
+        self.assertTrue(len(view.pages) * view.PAGE_SIZE < len(data) / 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,10 +5,14 @@
 
 import testutils
 
+import io
+import struct
 import unittest
 
 nes = testutils.loadModule("nes")
 
+from pyrominfo import RomInfo
+
 class TestNESParser(unittest.TestCase):
     def setUp(self):
         self.nesParser = nes.NESParser()
@@ -26,5 +30,43 @@ class TestNESParser(unittest.TestCase):
         self.assertEqual(props["video_output"], "")
         self.assertEqual(props["title"], "Dancing Blocks (72 pin cart)")
 
+    def test_unif(self):
+        def chunk(ID, data):
+            return ID + struct.pack("<I", len(data)) + data
+
+        data = b"UNIF" + struct.pack("<I", 7) + b"\x00" * 24
+        data += chunk(b"MAPR", b"NES-NROM-256\x00")
+        data += chunk(b"DINF", b"") # Chunks without data must not stall the walk
+        data += chunk(b"PRG0", b"\xff" * 0x40000)
+        data += chunk(b"NAME", b"Dancing Blocks\x00")
+        data += chunk(b"TVCI", b"\x01")
+        data += chunk(b"MIRR", b"\x04")
+        data += chunk(b"BATR", b"\x01")
+        data += chunk(b"CHR0", b"\xff" * 0x40000)
+
+        view = nes.RomView(io.BytesIO(data))
+        props = self.nesParser.parseBuffer(view)
+        self.assertEqual(props, self.nesParser.parseBuffer(bytearray(data)))
+        self.assertEqual(props["header"], "UNIF")
+        self.assertEqual(props["title"], "Dancing Blocks")
+        self.assertEqual(props["video_output"], "PAL")
+        self.assertEqual(props["four_screen_vram"], "yes")
+        self.assertEqual(props["battery"], "yes")
+        # The PRG and CHR payloads are skipped
+        self.assertEqual(len(view.pages), 2)
+
+        # File objects are told UNIF by their magic, not by their name
+        props = self.nesParser.parse(io.BytesIO(data))
+        self.assertEqual(props["title"], "Dancing Blocks")
+        self.assertEqual(props["video_output"], "PAL")
+        self.assertEqual(RomInfo.parse(io.BytesIO(data)), props)
+
+        # The last of repeated chunks wins
+        data += chunk(b"NAME", b"Dancing Blocks (72 pin cart)\x00")
+        data += chunk(b"TVCI", b"\x00")
+        props = self.nesParser.parseBuffer(nes.RomView(io.BytesIO(data)))
+        self.assertEqual(props["title"], "Dancing Blocks (72 pin cart)")
+        self.assertEqual(props["video_output"], "NTSC")
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,10 @@
 
 import testutils
 
+import hashlib
+import os
+import shutil
+import tempfile
 import unittest
 
 nintendo64 = testutils.loadModule("nintendo64")
@@ -29,5 +33,58 @@ class TestNintendo64Parser(unittest.TestCase):
         self.assertEqual(props["region"], "USA")
         self.assertEqual(props["region_code"], "45")
 
+    def test_nintendo64_crc(self):
+        # Boot code of this image is missing, so the CIC chip can't be identified
+        props = self.n64Parser.parse("data/Super Smash Bros.z64", verify=True)
+        self.assertEqual(props["cic"], "")
+        self.assertFalse(props["crc_valid"])
+
+        data = bytearray(b"".join(hashlib.sha1(str(i).encode()).digest() for i in range(0x101000 // 20 + 1)))
+        data = data[ : 0x101000]
+        expected = {6102: (0x70516417, 0xE10A5C04), 6105: (0x8E043E99, 0xC25467E8)}
+        numpy = nintendo64.numpy
+        try:
+            for module in set([numpy, None]):
+                # Reduced by numpy (if available) and by the plain loop
+                nintendo64.numpy = module
+                for cic in expected:
+                    self.assertEqual(self.n64Parser.calculateCRCs(data, cic), expected[cic])
+        finally:
+            nintendo64.numpy = numpy
+        self.assertEqual(self.n64Parser.calculateCRCs(data, None), None)
+
+    def test_nintendo64_convert(self):
+        with open("data/Super Smash Bros.z64", "rb") as f:
+            native = bytearray(f.read()) + bytearray(range(256)) * 0x40
+        # Source byte of each byte of a word
+        images = {
+            "v64": (1, 0, 3, 2),
+            "n64": (3, 2, 1, 0),
+            "wordswapped": (2, 3, 0, 1),
+        }
+        tmpdir = tempfile.mkdtemp()
+        numpy = nintendo64.numpy
+        try:
+            # Convert several chunks, with numpy (if available) and with arrays
+            self.n64Parser.CHUNK_SIZE = 0x1000
+            for module in set([numpy, None]):
+                nintendo64.numpy = module
+                for name, order in images.items():
+                    data = bytearray(len(native))
+                    for i, j in enumerate(order):
+                        data[i::4] = native[j::4]
+                    filename = os.path.join(tmpdir, name)
+                    with open(filename, "wb") as f:
+                        f.write(data)
+                    self.assertTrue(self.n64Parser.convertFile(filename, filename + ".z64"))
+                    self.assertTrue(self.n64Parser.convertFile(filename))
+                    for path in [filename, filename + ".z64"]:
+                        with open(path, "rb") as f:
+                            self.assertTrue(bytearray(f.read()) == native)
+            self.assertFalse(self.n64Parser.convertFile("data/Tetris.gb"))
+        finally:
+            nintendo64.numpy = numpy
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import testutils
+
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+gameboy = testutils.loadModule("gameboy")
+gba = testutils.loadModule("gba")
+genesis = testutils.loadModule("genesis")
+nintendo64 = testutils.loadModule("nintendo64")
+snes = testutils.loadModule("snes")
+
+import pyrominfo
+from pyrominfo import RomInfo
+from pyrominfo.rominfo import RomInfoParser
+
+try:
+    import concurrent.futures
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+class TestRomInfo(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(len(RomInfo.parse("data/empty")), 0)
+        self.assertEqual(RomInfo.parse("data/Tetris.gb")["title"], "TETRIS")
+        self.assertEqual(RomInfo.parse("data/Super Smash Bros.z64")["title"], "SMASH BROTHERS")
+
+    def test_verify(self):
+        self.assertFalse("header_checksum_valid" in RomInfo.parse("data/Tetris.gb"))
+        self.assertTrue(RomInfo.parse("data/Tetris.gb", verify=True)["header_checksum_valid"])
+        with open("data/Super Smash Bros.z64", "rb") as f:
+            props = RomInfo.parseBuffer(f.read(), verify=True)
+        # The test image is only a header, so its CRCs don't check out
+        self.assertFalse(props["crc_valid"])
+        results = dict(RomInfo.scan(["data/Tetris.gb", "data/Super Smash Bros.z64"], workers=2, verify=True))
+        self.assertTrue(results["data/Tetris.gb"]["header_checksum_valid"])
+        self.assertEqual(results["data/Super Smash Bros.z64"], props)
+
+    def test_dispatch(self):
+        self.assertEqual([type(p) for p in RomInfoParser.getParsersForExtension("gbc")], [gameboy.GameboyParser])
+        self.assertEqual(RomInfoParser.getParsersForExtension("txt"), ())
+
+        # Files with unknown extensions are identified by their contents
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "Tetris")
+            shutil.copy("data/Tetris.gb", filename)
+            self.assertEqual(RomInfo.parse(filename)["title"], "TETRIS")
+            shutil.copy("data/Super Smash Bros.z64", filename + ".rom")
+            self.assertEqual(RomInfo.parse(filename + ".rom")["title"], "SMASH BROTHERS")
+
+            # Only signatures identify them, not the heuristics that accept
+            # most data of the right size
+            for (name, data) in [("notes.txt", b"hello " * 256), ("photo.jpg", b"\xff\xd8\xff\xe0" * 384),
+                                 ("readme.nfo", b"\x00\x00" + b"\x20" * 598)]:
+                filename = os.path.join(tmpdir, name)
+                with open(filename, "wb") as f:
+                    f.write(data)
+                self.assertEqual(RomInfo.parse(filename), {})
+                with open(filename, "rb") as f:
+                    self.assertEqual(RomInfo.parse(io.BytesIO(f.read())), {})
+            # Missing files and directories are misses, not errors
+            self.assertEqual(RomInfo.parse(os.path.join(tmpdir, "missing.txt")), {})
+            self.assertEqual(RomInfo.parse(os.path.join(tmpdir, "missing")), {})
+            os.mkdir(os.path.join(tmpdir, "saves.d"))
+            self.assertEqual(RomInfo.parse(os.path.join(tmpdir, "saves.d")), {})
+            self.assertEqual(RomInfo.parse(tmpdir), {})
+
+            errors = []
+            names = ["notes.txt", "photo.jpg", "readme.nfo"]
+            results = RomInfo.scan([os.path.join(tmpdir, name) for name in names], workers=1,
+                                   onError=lambda path, e: errors.append(e))
+            self.assertEqual([props for (path, props) in results], [{}] * 3)
+            self.assertEqual(errors, [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_signatures(self):
+        with open("data/The Legend of Zelda - Links Awakening DX.gbc", "rb") as f:
+            data = bytearray(f.read())
+        self.assertEqual([type(p) for p in RomInfoParser.getParsersForData(data)], [gameboy.GameboyParser])
+        self.assertEqual(RomInfo.parseBuffer(data)["title"], "ZELDA")
+
+        # Byteswapped N64 header
+        with open("data/Super Smash Bros.z64", "rb") as f:
+            data = bytearray(f.read())
+        data[::2], data[1::2] = data[1::2], data[::2]
+        self.assertEqual([type(p) for p in RomInfoParser.getParsersForData(data)], [nintendo64.Nintendo64Parser])
+        self.assertEqual(RomInfo.parseBuffer(data)["title"], "SMASH BROTHERS")
+
+    def test_hashes(self):
+        with open("data/Tetris.gb", "rb") as f:
+            data = f.read()
+        props = RomInfo.parse("data/Tetris.gb", hashes=["crc32", "md5", "sha1"])
+        self.assertEqual(props["title"], "TETRIS")
+        self.assertEqual(props["crc32"], "%08X" % (zlib.crc32(data) & 0xffffffff))
+        self.assertEqual(props["md5"], hashlib.md5(data).hexdigest().upper())
+        self.assertEqual(props["sha1"], hashlib.sha1(data).hexdigest().upper())
+
+        # Byteswapped N64 images hash in native byte order
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open("data/Super Smash Bros.z64", "rb") as f:
+                data = bytearray(f.read())
+            expected = RomInfo.parse("data/Super Smash Bros.z64", hashes=["sha1"])["sha1"]
+            self.assertEqual(expected, hashlib.sha1(data).hexdigest().upper())
+            data[::2], data[1::2] = data[1::2], data[::2]
+            filename = os.path.join(tmpdir, "Super Smash Bros.v64")
+            with open(filename, "wb") as f:
+                f.write(data)
+            self.assertEqual(RomInfo.parse(filename, hashes=["sha1"])["sha1"], expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_inputs(self):
+        with open("data/Tetris.gb", "rb") as f:
+            data = f.read()
+        self.assertEqual(RomInfo.parseBuffer(data)["title"], "TETRIS")
+        self.assertEqual(RomInfo.parseBuffer(memoryview(data))["title"], "TETRIS")
+        self.assertEqual(RomInfo.parseBuffer(io.BytesIO(data))["title"], "TETRIS")
+        # File objects are parsed like files, sniffed if they have no name
+        self.assertEqual(RomInfo.parse(io.BytesIO(data))["title"], "TETRIS")
+        with open("data/Super Smash Bros.z64", "rb") as f:
+            self.assertEqual(RomInfo.parse(f)["title"], "SMASH BROTHERS")
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.assertEqual(RomInfo.parseBuffer(m)["title"], "SMASH BROTHERS")
+            finally:
+                m.close()
+
+        # Byteswapped images are converted in a copy
+        with open("data/Super Smash Bros.z64", "rb") as f:
+            data = bytearray(f.read())
+        data[::2], data[1::2] = data[1::2], data[::2]
+        swapped = bytearray(data)
+        self.assertEqual(RomInfo.parseBuffer(data)["title"], "SMASH BROTHERS")
+        self.assertTrue(data == swapped)
+
+    def test_scan(self):
+        expected = {
+            os.path.join("data", "Tetris.gb"): "TETRIS",
+            os.path.join("data", "The Legend of Zelda - Links Awakening DX.gbc"): "ZELDA",
+            os.path.join("data", "Golden Sun - The Lost Age.gba"): "GOLDEN_SUN_B",
+            os.path.join("data", "Super Smash Bros.z64"): "SMASH BROTHERS",
+        }
+        for executor in ["thread", "process"]:
+            errors = []
+            results = dict(RomInfo.scan(["data", "data/missing.gb"], workers=2, executor=executor,
+                                        onError=lambda path, e: errors.append(path)))
+            self.assertEqual(dict((path, props["title"]) for path, props in results.items() if props), expected)
+            self.assertEqual(results[os.path.join("data", "empty")], {})
+            self.assertEqual(results["data/missing.gb"], {})
+            self.assertEqual(errors, ["data/missing.gb"])
+
+        # Tasks failing in the pool (e.g. with results that can't be pickled)
+        # are reported instead of waited for
+        def failTask(path, *args):
+            raise ValueError(path)
+        parseFile = pyrominfo._parseFile
+        pyrominfo._parseFile = failTask
+        try:
+            errors = []
+            results = list(RomInfo.scan(["data/Tetris.gb"], workers=1, onError=lambda path, e: errors.append(e)))
+        finally:
+            pyrominfo._parseFile = parseFile
+        self.assertEqual(results, [("data/Tetris.gb", {})])
+        self.assertTrue(isinstance(errors[0], ValueError))
+
+    @unittest.skipIf(asyncio is None, "asyncio (or trollius) is not installed")
+    def test_async(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            props = loop.run_until_complete(RomInfo.aparse("data/Tetris.gb", loop=loop))
+            self.assertEqual(props["title"], "TETRIS")
+            self.assertRaises(IOError, loop.run_until_complete, RomInfo.aparse("data/missing.gb", loop=loop))
+
+            # Parses wait for the semaphore, and can be cancelled meanwhile
+            semaphore = asyncio.Semaphore(1)
+            loop.run_until_complete(semaphore.acquire())
+            future = RomInfo.aparse("data/Tetris.gb", semaphore=semaphore, loop=loop)
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertFalse(future.done())
+            future.cancel()
+            semaphore.release()
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertFalse(semaphore.locked())
+
+            errors = []
+            scan = RomInfo.ascan(["data", "data/missing.gb"], semaphore=semaphore, maxPending=2, loop=loop,
+                                 onError=lambda path, e: errors.append(path))
+            results = {}
+            while True:
+                try:
+                    (path, props) = loop.run_until_complete(scan.__anext__())
+                except pyrominfo.StopAsyncIteration:
+                    break
+                results[path] = props
+            self.assertEqual(results[os.path.join("data", "Tetris.gb")]["title"], "TETRIS")
+            self.assertEqual(results["data/missing.gb"], {})
+            self.assertEqual(errors, ["data/missing.gb"])
+
+            # Executor failures are reported like parse errors
+            class BrokenExecutor(concurrent.futures.ThreadPoolExecutor):
+                def submit(self, fn, *args, **kwargs):
+                    if fn is not pyrominfo._parseFile:
+                        return concurrent.futures.ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+                    future = concurrent.futures.Future()
+                    future.set_exception(RuntimeError("broken pool"))
+                    return future
+            executor = BrokenExecutor(1)
+            errors = []
+            scan = RomInfo.ascan("data/Tetris.gb", executor=executor, loop=loop,
+                                 onError=lambda path, e: errors.append((path, e)))
+            self.assertEqual(loop.run_until_complete(scan.__anext__()), ("data/Tetris.gb", {}))
+            self.assertRaises(pyrominfo.StopAsyncIteration, loop.run_until_complete, scan.__anext__())
+            self.assertTrue(isinstance(errors[0][1], RuntimeError))
+            executor.shutdown()
+
+            # Cancelling the scan cancels the pending result
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+            scan = RomInfo.ascan("data", executor=executor, maxPending=1, loop=loop)
+            (path, props) = loop.run_until_complete(scan.__anext__())
+            future = scan.__anext__()
+            scan.cancel()
+            self.assertTrue(future.cancelled())
+            self.assertTrue(scan.__anext__().cancelled())
+            # Let a parse that was already running finish before the loop closes
+            executor.shutdown()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+if __name__ == '__main__':
+    unittest.main()
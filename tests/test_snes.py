@@ -5,6 +5,8 @@
 
 import testutils
 
+import io
+import struct
 import unittest
 
 snes = testutils.loadModule("snes")
@@ -33,7 +35,75 @@ class TestSNESParser(unittest.TestCase):
         self.assertEquals(props["version"], "00")
         self.assertEquals(props["checksum"], "A0DA")
         self.assertEquals(props["checksum_complement"], "5F25")
-        
+
+    def test_snes_view(self):
+        # 4 Mbit LoROM with a 512-byte copier header
+        data = bytearray(512 + 0x80000)
+        header = 512 + 0x7fc0
+        data[header : header + 21] = b"SUPER MARIOWORLD     "
+        data[header + 0x15 : header + 0x1c] = b"\x20\x02\x09\x01\x01\x01\x00"
+        data[header + 0x1c : header + 0x20] = struct.pack("<HH", 0x5F25, 0xA0DA)
+        data[header + 0x3c : header + 0x3e] = struct.pack("<H", 0x8000)
+
+        view = snes.RomView(io.BytesIO(bytes(data)))
+        props = self.snesParser.parseBuffer(view)
+        self.assertEqual(props, self.snesParser.parseBuffer(data))
+        self.assertEqual(props["title"], "SUPER MARIOWORLD")
+        self.assertEqual(props["memory_layout"], "LoROM")
+        self.assertEqual(props["checksum"], "A0DA")
+        # Only the copier header and the pages around 0x7fc0 and 0xffc0 are read
+        self.assertTrue(len(view.pages) * view.PAGE_SIZE <= 0x4000)
+
+    def test_snes_deinterleave(self):
+        # Tag each 32 KB block of a 4 Mbit image with its block number
+        data = bytearray()
+        for block in range(16):
+            data += bytearray([block]) * 0x8000
+        self.assertEqual(self.snesParser.getType1BlockOrder(len(data)), [4, 0, 5, 1, 6, 2, 7, 3])
+
+        view = snes.Type1View(snes.RomView(bytes(data)), self.snesParser.getType1BlockOrder(len(data)))
+        self.snesParser.deinterleaveType1(data, len(data))
+        self.assertEqual([data[block << 15] for block in range(16)], [4, 0, 5, 1, 6, 2, 7, 3] + list(range(8, 16)))
+        self.assertTrue(view.load() == data)
+        self.assertEqual(view[0x7ffe : 0x8002], data[0x7ffe : 0x8002])
+
+    def test_snes_checksum(self):
+        # 3 Mbit LoROM: the last 1 Mbit is mirrored to fill 4 Mbit
+        data = bytearray(range(256)) * (0x60000 // 256)
+        header = 0x7fc0
+        data[header : header + 21] = b"CHECKSUM TEST        "
+        data[header + 0x15 : header + 0x1c] = b"\x20\x00\x09\x00\x01\x01\x00"
+        data[header + 0x1c : header + 0x20] = struct.pack("<HH", 0xFFFF, 0x0000)
+        data[header + 0x3c : header + 0x3e] = struct.pack("<H", 0x8000)
+        # Complement and checksum always add 0x1FE to the sum
+        checksum = (sum(data[ : 0x40000]) + 2 * sum(data[0x40000 : ])) & 0xffff
+        data[header + 0x1c : header + 0x20] = struct.pack("<HH", checksum ^ 0xffff, checksum)
+
+        props = self.snesParser.parseBuffer(data, verify=True)
+        self.assertEqual(props["checksum"], "%04X" % checksum)
+        self.assertTrue(props["checksum_valid"])
+        self.assertEqual(self.snesParser.parseBuffer(snes.RomView(io.BytesIO(bytes(data))), verify=True), props)
+        self.assertFalse("checksum_valid" in self.snesParser.parseBuffer(data))
+
+        data[0x50000] ^= 0xff
+        self.assertFalse(self.snesParser.parseBuffer(data, verify=True)["checksum_valid"])
+
+    def test_snes_checksum_bsx_bios(self):
+        # The BS-X BIOS sums its header like a regular cart, unlike BS-X flash carts
+        data = bytearray(range(256)) * (0x40000 // 256)
+        header = 0x7fc0
+        data[header : header + 21] = b"Satellaview BS-X     "
+        data[header + 0x15 : header + 0x1c] = b"\x20\x00\x08\x00\x01\x01\x00"
+        data[header + 0x1c : header + 0x20] = struct.pack("<HH", 0xFFFF, 0x0000)
+        data[header + 0x3c : header + 0x3e] = struct.pack("<H", 0x8000)
+        checksum = sum(data) & 0xffff
+        data[header + 0x1c : header + 0x20] = struct.pack("<HH", checksum ^ 0xffff, checksum)
+
+        props = self.snesParser.parseBuffer(data, verify=True)
+        self.assertEqual(props["title"], "Satellaview BS-X")
+        self.assertEqual(props["checksum"], "%04X" % checksum)
+        self.assertTrue(props["checksum_valid"])
+
 
 if __name__ == '__main__':
     unittest.main()
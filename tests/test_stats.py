@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Garrett Brown
+# See Copyright Notice in rominfo.py
+
+import testutils
+
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError
+
+gameboy = testutils.loadModule("gameboy")
+gba = testutils.loadModule("gba")
+nintendo64 = testutils.loadModule("nintendo64")
+rominfo = testutils.loadModule("rominfo")
+stats = testutils.loadModule("stats")
+
+from pyrominfo import RomInfo
+from pyrominfo.rominfo import RomInfoParser
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.hook = lambda event, parser, details: self.events.append((event, parser, details))
+        RomInfoParser.addHook(self.hook)
+
+    def tearDown(self):
+        RomInfoParser.removeHook(self.hook)
+
+    def test_events(self):
+        RomInfo.parse("data/Tetris.gb")
+        names = [event for (event, parser, details) in self.events]
+        self.assertEqual(names[ : 2], ["dispatch", "open"])
+        self.assertEqual(names[-2 : ], ["parse", "result"])
+        self.assertTrue("read" in names)
+        (event, parser, details) = self.events[-1]
+        self.assertTrue(isinstance(parser, gameboy.GameboyParser))
+        self.assertEqual((details["filename"], details["found"], details["tried"]), ("data/Tetris.gb", True, 1))
+        times = [details["time"] for (event, parser, details) in self.events]
+        self.assertEqual(times, sorted(times))
+
+        # Files of unknown type are sniffed on RomInfo's behalf, then validated
+        del self.events[:]
+        RomInfo.parse("data/empty")
+        self.assertEqual([(event, parser) for (event, parser, details) in self.events],
+                         [("dispatch", None), ("open", None), ("result", None)])
+        self.assertFalse(self.events[-1][2]["found"])
+
+        # Errors are reported before they propagate
+        del self.events[:]
+        self.assertRaises(IOError, RomInfo.parse, "data/missing.gb")
+        (event, parser, details) = self.events[-1]
+        self.assertEqual(event, "parse")
+        self.assertTrue(isinstance(details["error"], IOError))
+
+        # Durations are never negative, even if the clock steps back
+        del self.events[:]
+        rominfo._emit("parse", None, duration=-0.5)
+        self.assertEqual(self.events[0][2]["duration"], 0)
+
+        # Hooks removed while an event is delivered don't make others miss it
+        def removeSelf(event, parser, details):
+            RomInfoParser.removeHook(removeSelf)
+        RomInfoParser.removeHook(self.hook)
+        RomInfoParser.addHook(removeSelf)
+        RomInfoParser.addHook(self.hook)
+        del self.events[:]
+        rominfo._emit("dispatch", None)
+        self.assertEqual(len(self.events), 1)
+
+        # Removed hooks get no more events
+        RomInfoParser.removeHook(self.hook)
+        del self.events[:]
+        RomInfo.parse("data/Tetris.gb")
+        self.assertEqual(self.events, [])
+        RomInfoParser.addHook(self.hook)
+
+    def test_counters(self):
+        counters = stats.ParserCounters()
+        RomInfoParser.addHook(counters)
+        try:
+            RomInfo.parse("data/Tetris.gb")
+            RomInfo.parse("data/Golden Sun - The Lost Age.gba")
+            RomInfo.parse("data/empty")
+            with open("data/Super Smash Bros.z64", "rb") as f:
+                RomInfo.parseBuffer(bytearray(f.read()))
+            self.assertRaises(IOError, RomInfo.parse, "data/missing.gb")
+        finally:
+            RomInfoParser.removeHook(counters)
+
+        c = counters.getCounters()
+        self.assertEqual((c["GameboyParser"]["parses"], c["GameboyParser"]["found"], c["GameboyParser"]["errors"]),
+                         (2, 1, 1))
+        self.assertEqual(c["GameboyParser"]["bytes_read"], 336)
+        self.assertEqual(c["GBAParser"]["found"], 1)
+        self.assertEqual((c["Nintendo64Parser"]["validations"], c["Nintendo64Parser"]["found"]), (1, 1))
+        self.assertEqual((c[None]["dispatches"], c[None]["misses"]), (5, 1))
+        self.assertTrue(c["GameboyParser"]["parse_time"] > 0)
+
+        counters.reset()
+        self.assertEqual(counters.getCounters(), {})
+
+    def test_metrics(self):
+        metrics = stats.ScanMetrics()
+        RomInfoParser.addHook(metrics)
+        try:
+            RomInfo.parse("data/Tetris.gb")
+            RomInfo.parse("data/Golden Sun - The Lost Age.gba")
+            RomInfo.parse("data/empty")
+            self.assertRaises(IOError, RomInfo.parse, "data/missing.gb")
+        finally:
+            RomInfoParser.removeHook(metrics)
+
+        text = metrics.render()
+        lines = text.splitlines()
+        self.assertEqual(lines[-1], "# EOF")
+        for line in ["# TYPE pyrominfo_files counter",
+                     "pyrominfo_files_total 4",
+                     'pyrominfo_found_total{parser="GameboyParser"} 1',
+                     'pyrominfo_found_total{parser="GBAParser"} 1',
+                     "pyrominfo_misses_total 1",
+                     'pyrominfo_errors_total{parser="GameboyParser"} 1',
+                     "# UNIT pyrominfo_parse_duration_seconds seconds",
+                     'pyrominfo_parse_duration_seconds_bucket{parser="GameboyParser",le="+Inf"} 2',
+                     'pyrominfo_parse_duration_seconds_count{parser="GameboyParser"} 2']:
+            self.assertTrue(line in lines, line)
+        bytesRead = [line for line in lines if line.startswith("pyrominfo_read_bytes_total ")]
+        self.assertTrue(int(bytesRead[0].split()[1]) > 336)
+        buckets = [int(line.split()[1]) for line in lines
+                   if line.startswith('pyrominfo_parse_duration_seconds_bucket{parser="GameboyParser"')]
+        self.assertEqual(len(buckets), len(metrics.BUCKETS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+        (filesPerSec, bytesPerSec) = metrics.getRates()
+        self.assertTrue(filesPerSec > 0 and bytesPerSec > 0)
+
+        with stats.MetricsServer(metrics, 0) as server:
+            response = urlopen("http://127.0.0.1:%d/metrics" % server.port)
+            self.assertTrue(response.info()["Content-Type"].startswith("application/openmetrics-text"))
+            self.assertTrue("pyrominfo_files_total 4" in response.read().decode("utf-8"))
+            self.assertRaises(HTTPError, urlopen, "http://127.0.0.1:%d/missing" % server.port)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "pyrominfo.prom")
+            with stats.MetricsWriter(metrics, filename, interval=3600):
+                pass
+            with open(filename) as f:
+                self.assertTrue("pyrominfo_misses_total 1" in f.read().splitlines())
+            self.assertEqual(os.listdir(directory), ["pyrominfo.prom"])
+        finally:
+            shutil.rmtree(directory)
+
+        metrics.reset()
+        self.assertTrue("pyrominfo_files_total 0" in metrics.render().splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
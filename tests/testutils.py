@@ -1,6 +1,8 @@
 # Copyright (C) 2013 Garrett Brown
 # See Copyright Notice in rominfo.py
 
+import struct
+
 def loadModule(mod):
     """
     This will first try to load the specified module from the pyrominfo package
@@ -20,3 +22,57 @@ def loadModule(mod):
         return getattr(pyrominfo, mod)
     except AttributeError:
         raise ImportError("testutils.loadModule() can't find module %s in pyrominfo package" % mod)
+
+def makeIPBin(title=b"TEST TITLE"):
+    """
+    Return the IP.BIN of a fictional Dreamcast disc, see
+    DreamcastParser.parseBuffer().
+    """
+    return b"".join([
+        b"SEGA SEGAKATANA ",
+        b"SEGA ENTERPRISES",
+        b"4A1B ",
+        b"GD-ROM1/1  ",
+        b"JUE     ",
+        b"0799A10 ",
+        b"T-1234M   ",
+        b"V1.000",
+        b"20000101",
+        b" " * 8,
+        b"1ST_READ.BIN",
+        b" " * 4,
+        b"SEGA LC-T-1234  ",
+        title.ljust(96),
+        b" " * 32,
+    ])
+
+def makeCDI(version, sessions, fill=bytearray):
+    """
+    Build a DiscJuggler (CDI) image from a list of sessions, each a list of
+    (mode, sector size id, pregap, length, lba, sector data) tracks. Tracks
+    are padded to their length with fill(size), zeros by default.
+    """
+    dreamcast = loadModule("dreamcast")
+    sizes = {0: 2048, 1: 2336, 2: 2352}
+    data = bytearray()
+    descriptors = struct.pack("<H", len(sessions))
+    for session in sessions:
+        descriptors += struct.pack("<H", len(session))
+        for (mode, sizeId, pregap, length, lba, sectors) in session:
+            track = bytearray(pregap * sizes[sizeId]) + sectors
+            data += track + fill(max((pregap + length) * sizes[sizeId] - len(track), 0))
+            descriptors += struct.pack("<I", 0)
+            descriptors += dreamcast.cdi_track_start_marks
+            descriptors += b"\x00" * 4 + struct.pack("<B", 5) + b"track"
+            descriptors += b"\x00" * 19 + struct.pack("<I", 0)
+            descriptors += dreamcast.cdi_track_info.pack(pregap, length, mode, lba, pregap + length, sizeId)
+            descriptors += b"\x00" * 29
+            if version != dreamcast.CDI_V2:
+                descriptors += b"\x00" * 5 + struct.pack("<I", 0)
+        descriptors += b"\x00" * 12
+        if version != dreamcast.CDI_V2:
+            descriptors += b"\x00"
+    headerOffset = len(data)
+    if version == dreamcast.CDI_V35:
+        headerOffset = len(descriptors) + 8
+    return data + descriptors + struct.pack("<II", version, headerOffset)